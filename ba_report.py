@@ -64,7 +64,7 @@ class PimaReport :
                     if self.analysis.ont_fast5 :
                         table.add_row(('ONT FAST5', self.analysis.ont_fast5))
                     if self.analysis.ont_raw_fastq :
-                        table.add_row(('ONT FASTQ', self.analysis.ont_raw_fastq))
+                        table.add_row(('ONT FASTQ', self.analysis.ont_raw_fastq_label))
                     if self.analysis.illumina_fastq :
                         table.add_row(('Illumina FASTQ', ', '.join(self.analysis.illumina_fastq)))
                     if self.analysis.genome_fasta :
@@ -1,20 +1,35 @@
 #!/bin/env python
 
-import copy
+import array
+import concurrent.futures
 import csv
+import copy
+import ctypes
 import datetime
 import glob
+import gzip
+import hashlib
+import itertools
+import json
 import locale
 import logging
 import os
 import re
+import resource
+import select
+import signal
+import struct
+import types
 import pyfastx
+import queue
 import shutil
 import statistics
 import subprocess
 import sys
+import threading
 import time
-from argparse import ArgumentParser, HelpFormatter
+import zlib
+from argparse import ArgumentParser, HelpFormatter, Namespace
 
 import numpy
 import pandas
@@ -47,6 +62,143 @@ included_databases = [amr_database_default, inc_database_default]
 plasmid_database_default = f"{pima_path}/data/plasmids_and_vectors.fasta"
 reference_dir_default = f"{pima_path}/reference_sequences"
 
+# What each analysis step reads and writes, in terms of Analysis attributes (and a few report
+# sections/shared resources).  Analysis.go() uses this to figure out which steps can run at the
+# same time.  Barrier steps, and any step not listed here, run on their own.  'dir' is the
+# directory under the output directory that holds the step's .start/.finish files.  Steps with
+# 'cache' can be reused from --cache-dir; their key also covers 'params' (other options the
+# step depends on) and the versions of 'tools'; cached files are hardlinked unless the step
+# 'edits_outputs' in place later on.  With --resume, an unfinished step's directory is
+# removed before rerunning it, unless the step is 'resumable' and picks up from what's there.
+# Steps that 'stream' read ont_fastq_for() the step in one pass, so with --stream-reads the ones
+# starting together can share one pass over the reads (see ont_fastq_stream()).  'streams_unless'
+# lists attributes that, when set, mean the step reads something else instead.
+analysis_steps = {
+    'make_output_dir' : {'barrier' : True},
+    'download_databases' : {'barrier' : True},
+    'watch_ont' : {'dir' : 'ont_fastq', 'resumable' : True,
+                   'outputs' : ['ont_fastq', 'ont_raw_fastq', 'basecalling_methods', 'read_screen_hits']},
+    'guppy_ont_fast5' : {'dir' : 'ont_fastq', 'outputs' : ['ont_fastq', 'ont_raw_fastq', 'basecalling_methods']},
+    'qcat_ont_fastq' : {'dir' : 'demultiplex', 'barrier' : True},
+    'start_barcode_analysis' : {'barrier' : True},
+    'ont_fastq_info' : {'inputs' : ['ont_fastq'],
+                        'outputs' : ['ont_n50', 'assembly_notes']},
+    'illumina_fastq_info' : {'inputs' : ['illumina_fastq'],
+                             'outputs' : ['illumina_length_mean']},
+    'screen_ont_reads' : {'dir' : 'read_screen', 'inputs' : ['ont_fastq', 'feature_fastas'],
+                          'outputs' : ['read_screen_hits'], 'streams' : True,
+                          'cache' : True, 'tools' : ['minimap2']},
+    'estimate_genome_size' : {'inputs' : ['ont_fastq'], 'streams' : True,
+                              'outputs' : ['genome_assembly_size', 'assembly_methods']},
+    'lorma_ont_fastq' : {'inputs' : ['ont_fastq'],
+                         'outputs' : ['ont_fastq']},
+    'subsample_ont_fastq' : {'dir' : 'subsample', 'inputs' : ['ont_fastq', 'genome_assembly_size', 'reference_fasta'],
+                             'outputs' : ['ont_fastq_subsets', 'ont_fastq_subset_scales'],
+                             'cache' : True, 'params' : ['ont_depths']},
+    'miniasm_ont_fastq' : {'dir' : 'ont_assembly', 'inputs' : ['ont_fastq'],
+                           'outputs' : ['genome_fasta'],
+                           'cache' : True, 'tools' : ['minimap2', 'miniasm']},
+    'wtdbg2_ont_fastq' : {'dir' : 'ont_assembly', 'inputs' : ['ont_fastq', 'genome_assembly_size'],
+                          'outputs' : ['genome_fasta'],
+                          'cache' : True, 'tools' : ['wtdbg2']},
+    'flye_ont_fastq' : {'dir' : 'ont_assembly', 'inputs' : ['ont_fastq', 'genome_assembly_size'],
+                        'outputs' : ['genome_fasta', 'assembly_notes', 'assembly_methods'],
+                        'cache' : True, 'params' : ['error_correct'], 'tools' : ['flye']},
+    'racon_ont_assembly' : {'dir' : 'racon', 'inputs' : ['ont_fastq', 'ont_fastq_subsets', 'genome_fasta'],
+                            'outputs' : ['genome_fasta'],
+                            'cache' : True, 'params' : ['racon_rounds', 'racon_keep_paf'], 'tools' : ['racon', 'minimap2']},
+    'medaka_ont_assembly' : {'dir' : 'medaka', 'inputs' : ['ont_raw_fastq', 'ont_fastq_subsets', 'genome_fasta'],
+                             'outputs' : ['genome_fasta', 'assembly_methods'],
+                             'cache' : True, 'tools' : ['medaka']},
+    'nanopolish_ont_assembly' : {'dir' : 'nanopolish', 'inputs' : ['ont_fastq', 'genome_fasta'],
+                                 'outputs' : ['genome_fasta']},
+    'spades_illumina_fastq' : {'dir' : 'spades', 'inputs' : ['illumina_fastq'],
+                               'outputs' : ['genome_fasta'], 'edits_outputs' : True,
+                               'cache' : True, 'tools' : ['spades']},
+    'pilon_assembly' : {'dir' : 'pilon', 'inputs' : ['illumina_fastq', 'genome_fasta'],
+                        'outputs' : ['genome_fasta', 'assembly_notes', 'assembly_methods'],
+                        'cache' : True, 'params' : ['illumina_read_length_mean'], 'tools' : ['pilon', 'minimap2']},
+    'evaluate_assembly' : {'inputs' : ['genome_fasta'],
+                           'outputs' : ['assembly_notes']},
+    'assembly_info' : {'dir' : 'info', 'inputs' : ['genome_fasta', 'ont_fastq', 'ont_fastq_subsets', 'ont_fastq_subset_scales',
+                                                   'illumina_fastq', 'illumina_length_mean'],
+                       'outputs' : ['contig_info', 'assembly_notes'], 'streams' : True,
+                       'cache' : True, 'params' : ['illumina_read_length_mean'], 'tools' : ['minimap2', 'samtools']},
+    'blast_feature_sets' : {'dir' : 'features', 'inputs' : ['genome_fasta', 'feature_fastas'],
+                            'outputs' : ['feature_hits', 'feature_methods'],
+                            'cache' : True, 'tools' : ['makeblastdb', 'blastn', 'bedtools']},
+    'call_insertions' : {'dir' : 'insertions', 'inputs' : ['genome_fasta', 'reference_fasta', 'mutation_region_bed'],
+                         'outputs' : ['one_coords', 'reference_sizes', 'amr_deletions', 'alignment_notes',
+                                      'large_indels', 'reference_methods'],
+                         'cache' : True, 'tools' : ['dnadiff', 'bedtools']},
+    'quast_genome' : {'dir' : 'quast', 'inputs' : ['genome_fasta', 'reference_fasta'],
+                      'outputs' : ['quast_mismatches'],
+                      'cache' : True, 'tools' : ['quast']},
+    'draw_circos' : {'dir' : 'circos', 'inputs' : ['one_coords', 'reference_sizes', 'reference_fasta'],
+                     'outputs' : ['contig_alignments']},
+    'call_amr_mutations' : {'dir' : 'mutations', 'inputs' : ['ont_fastq', 'ont_fastq_subsets', 'illumina_fastq', 'reference_fasta',
+                                                             'mutation_region_bed'],
+                            'outputs' : ['amr_mutations', 'mutation_methods'], 'streams' : True,
+                            'streams_unless' : ['illumina_fastq'],
+                            'cache' : True, 'tools' : ['minimap2', 'samtools', 'bcftools']},
+    'draw_amr_matrix' : {'inputs' : ['feature_hits', 'amr_mutations', 'amr_deletions'],
+                         'outputs' : ['amr_matrix', 'matplotlib']},
+    'call_plasmids' : {'dir' : 'plasmids', 'inputs' : ['genome_fasta', 'plasmid_database'],
+                       'outputs' : ['plasmids', 'plasmid_methods'],
+                       'cache' : True, 'tools' : ['minimap2', 'R', 'Rscript']},
+    'draw_features' : {'dir' : 'drawing', 'inputs' : ['genome_fasta', 'feature_hits'],
+                       'outputs' : ['feature_plots', 'matplotlib']},
+    'make_report' : {'dir' : 'report', 'barrier' : True},
+    'clean_up' : {'barrier' : True},
+}
+
+# Step outputs that live in the report, as the Analysis attributes holding the section (and
+# subsection) titles.  'append' cells are lists of notes/methods that several steps add to.
+report_outputs = {
+    'assembly_notes' : ('append', 'assembly_title', 'assembly_notes_title'),
+    'alignment_notes' : ('append', 'alignment_title', 'alignment_notes_title'),
+    'basecalling_methods' : ('append', 'methods_title', 'basecalling_methods'),
+    'assembly_methods' : ('append', 'methods_title', 'assembly_methods'),
+    'reference_methods' : ('append', 'methods_title', 'reference_methods'),
+    'feature_methods' : ('append', 'methods_title', 'feature_methods'),
+    'mutation_methods' : ('append', 'methods_title', 'mutation_methods'),
+    'plasmid_methods' : ('append', 'methods_title', 'plasmid_methods'),
+    'contig_alignments' : ('set', 'alignment_title', 'contig_alignment_title'),
+    'feature_hits' : ('set', 'feature_title'),
+    'large_indels' : ('set', 'large_indel_title'),
+    'amr_mutations' : ('set', 'mutation_title'),
+    'plasmids' : ('set', 'plasmid_title'),
+}
+
+# Attributes that describe how this run is being carried out rather than what it has found.
+# These are not saved with, or restored from, the --resume state.
+transient_attributes = ['analysis', 'logging_handle', 'state_file', 'resume', 'overwrite', 'verbosity',
+                        'threads', 'max_parallel_steps', 'cache_dir', 'trace', 'thread_budget', 'opts',
+                        'read_fanouts', 'step_processes', 'running_step_states']
+
+# What each barcode's analysis takes from the multiplexed one on top of the options it's built from: what
+# validation worked out that a provisional analysis (which isn't validated) needs too.  Everything else,
+# the report included, a barcode's analysis sets up for itself.
+barcode_shared_attributes = ['feature_fastas', 'versions', 'start_time']
+
+# Part of every step cache key; bump it when what's cached, or how, changes
+cache_format_version = 2
+
+# Shared by every analysis in this process (e.g., all of the samples in a --sample-sheet run) so one-time
+# work like probing tool versions and indexing shared databases is done once
+version_probes = {}
+shared_file_locks = {}
+shared_file_locks_lock = threading.Lock()
+
+# pyplot isn't thread safe, so only one analysis draws at a time
+plot_lock = threading.Lock()
+
+# Per-thread information about the step being run
+step_context = threading.local()
+
+# Steps and commands from several threads add to the same trace
+trace_lock = threading.Lock()
+
 
 class Colors:
     HEADER = '\033[95m'
@@ -59,6 +211,273 @@ class Colors:
     UNDERLINE = '\033[4m'
 
 
+class Fast5Watcher :
+
+    # Reports FAST5 files as they show up in a directory.  Uses inotify where we have it (Linux), otherwise
+    # rescans the directory, but only when its mtime says something changed.
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_Q_OVERFLOW = 0x4000
+
+    def __init__(self, watch_dir) :
+        self.watch_dir = watch_dir
+        self.seen = set()
+        self.dir_mtime = None
+        self.inotify_fd = None
+        try :
+            libc = ctypes.CDLL(None, use_errno = True)
+            inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if inotify_fd >= 0 :
+                if libc.inotify_add_watch(inotify_fd, os.fsencode(watch_dir), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) >= 0 :
+                    self.inotify_fd = inotify_fd
+                else :
+                    os.close(inotify_fd)
+        except (OSError, AttributeError) :
+            pass
+        self.rescan_needed = True
+
+
+    def scan(self) :
+        new_fast5 = []
+        for entry in os.scandir(self.watch_dir) :
+            if entry.name.endswith('.fast5') and not entry.path in self.seen :
+                new_fast5 += [entry.path]
+        return new_fast5
+
+
+    def wait_for_fast5(self, timeout) :
+
+        # New FAST5 files since the last call, waiting up to timeout seconds for some
+        new_fast5 = []
+        if self.inotify_fd is not None :
+            # Files already there (or missed when the event queue overflowed) come from a rescan
+            if not self.rescan_needed :
+                if select.select([self.inotify_fd], [], [], timeout)[0] :
+                    events = os.read(self.inotify_fd, 2**16)
+                    i = 0
+                    while i < len(events) :
+                        watch, mask, cookie, name_length = struct.unpack_from('iIII', events, i)
+                        name = events[i + 16:i + 16 + name_length].rstrip(b'\0')
+                        i += 16 + name_length
+                        if mask & self.IN_Q_OVERFLOW :
+                            self.rescan_needed = True
+                        elif name.endswith(b'.fast5') :
+                            new_fast5 += [os.path.join(self.watch_dir, os.fsdecode(name))]
+            if self.rescan_needed :
+                self.rescan_needed = False
+                new_fast5 += self.scan()
+        else :
+            dir_mtime = os.stat(self.watch_dir).st_mtime
+            if dir_mtime == self.dir_mtime :
+                time.sleep(timeout)
+                dir_mtime = os.stat(self.watch_dir).st_mtime
+            if dir_mtime != self.dir_mtime :
+                self.dir_mtime = dir_mtime
+                new_fast5 = self.scan()
+
+        new_fast5 = [i for i in new_fast5 if not i in self.seen]
+        self.seen.update(new_fast5)
+        return new_fast5
+
+
+    def close(self) :
+        if self.inotify_fd is not None :
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+
+class ThreadBudget :
+
+    # Hands out threads to concurrently running steps so together they stay within --threads
+
+    def __init__(self, total) :
+        self.total = total
+        self.available = total
+        self.condition = threading.Condition()
+
+
+    def lease(self, wanted) :
+
+        # Take what's free, up to what's wanted, waiting only if nothing at all is free
+        with self.condition :
+            while self.available == 0 :
+                self.condition.wait()
+            granted = max(1, min(wanted, self.available))
+            self.available -= granted
+            return granted
+
+
+    def release(self, granted) :
+        with self.condition :
+            self.available += granted
+            self.condition.notify_all()
+
+
+    # Pickles (e.g., for pool workers) get a fresh budget of their own
+    def __getstate__(self) :
+        return {'total' : self.total}
+
+
+    def __setstate__(self, state) :
+        self.__init__(state['total'])
+
+
+class ReadFanout :
+
+    # Reads a read set once, uncompressed, into a named pipe per consumer, so that several tools reading the same
+    # reads at the same time share one pass over them.  A consumer that never opens its pipe, or stops reading,
+    # is dropped once released rather than holding up the others.  So is one that falls a queue behind before
+    # claiming its pipe (e.g., while it waits for threads); it reads the reads itself once it gets going.
+
+    def __init__(self, read_set, consumers, fifo_dir, threads = 1, queue_size = 16) :
+        self.read_set = read_set
+        self.fifos = {}
+        self.queues = {}
+        self.claimed = set()
+        self.released = set()
+        self.lock = threading.Lock()
+        os.makedirs(fifo_dir, exist_ok = True)
+        for consumer in consumers :
+            self.fifos[consumer] = os.path.join(fifo_dir, consumer + '.fastq')
+            if os.path.exists(self.fifos[consumer]) :
+                os.remove(self.fifos[consumer])
+            os.mkfifo(self.fifos[consumer])
+            self.queues[consumer] = queue.Queue(maxsize = queue_size)
+        self.writers = [threading.Thread(target = self.write, args = (consumer,), daemon = True) for consumer in consumers]
+        for writer in self.writers :
+            writer.start()
+        threading.Thread(target = self.read, args = (threads,), daemon = True).start()
+
+
+    def pipe(self, consumer) :
+
+        # A pipe can only be read once, so a consumer asking again, or after being dropped, gets nothing
+        with self.lock :
+            if consumer in self.claimed or consumer in self.released :
+                return None
+            self.claimed.add(consumer)
+            return self.fifos[consumer]
+
+
+    def release(self, consumer) :
+        with self.lock :
+            self.released.add(consumer)
+
+
+    def read(self, threads) :
+        try :
+            for fastq in read_set_files(self.read_set) :
+                for chunk in fastq_chunks(fastq, threads) :
+                    if len(self.released) == len(self.fifos) :
+                        return
+                    for consumer in self.queues :
+                        self.put(consumer, chunk)
+        finally :
+            for chunk_queue in self.queues.values() :
+                chunk_queue.put(None)
+            for writer in self.writers :
+                writer.join()
+            for fifo in self.fifos.values() :
+                os.remove(fifo)
+
+
+    def put(self, consumer, chunk) :
+
+        # Wait on consumers that are reading, but not on one that hasn't claimed its pipe
+        while not consumer in self.released :
+            try :
+                self.queues[consumer].put(chunk, timeout = 0.1)
+                return
+            except queue.Full :
+                with self.lock :
+                    if not consumer in self.claimed :
+                        self.released.add(consumer)
+
+
+    def write(self, consumer) :
+
+        # Opening a pipe blocks until its reader opens it, which a consumer that's done without it never will
+        fifo_handle = None
+        while fifo_handle is None and not consumer in self.released :
+            try :
+                fd = os.open(self.fifos[consumer], os.O_WRONLY | os.O_NONBLOCK)
+                os.set_blocking(fd, True)
+                fifo_handle = os.fdopen(fd, 'wb')
+            except OSError :
+                time.sleep(0.05)
+
+        # Once the consumer is gone, keep taking chunks so the others aren't held up
+        while True :
+            chunk = self.queues[consumer].get()
+            if chunk is None :
+                break
+            if fifo_handle is None :
+                continue
+            try :
+                fifo_handle.write(chunk)
+            except OSError :
+                self.close_pipe(fifo_handle)
+                fifo_handle = None
+        if fifo_handle is not None :
+            self.close_pipe(fifo_handle)
+
+
+    def close_pipe(self, fifo_handle) :
+        try :
+            fifo_handle.close()
+        except OSError :
+            pass
+
+
+class ReadScreen :
+
+    # Read support for feature sequences (AMR genes, Inc groups, ...) from minimap2 PAF of reads against them.
+    # Alignments are added as they stream in, so one screen can be kept across --ont-watch batches.
+
+    def __init__(self, min_identity = 0.8) :
+        self.min_identity = min_identity
+        self.lengths = {}
+        self.reads = {}
+        self.bases = {}
+        self.coverage = {}
+
+
+    def add_alignment(self, feature_set, paf_line) :
+        fields = paf_line.split('\t')
+        if len(fields) < 12 :
+            return
+        matches, block_length = int(fields[9]), int(fields[10])
+        if block_length == 0 or matches / block_length < self.min_identity :
+            return
+
+        # Coverage is kept as +1/-1 at the ends of each alignment and summed when asked for
+        feature = (feature_set, fields[5])
+        if not feature in self.lengths :
+            self.lengths[feature] = int(fields[6])
+            self.reads[feature] = 0
+            self.bases[feature] = 0
+            self.coverage[feature] = numpy.zeros(self.lengths[feature] + 1, dtype = numpy.int32)
+        start, end = int(fields[7]), int(fields[8])
+        self.reads[feature] += 1
+        self.bases[feature] += end - start
+        self.coverage[feature][start] += 1
+        self.coverage[feature][end] -= 1
+
+
+    def hits(self, min_reads = 2, min_covered = 0.9) :
+
+        # Features with enough reads covering enough of them to call, deepest first
+        rows = []
+        for feature in sorted(self.lengths) :
+            covered = numpy.count_nonzero(numpy.cumsum(self.coverage[feature][:-1])) / self.lengths[feature]
+            if self.reads[feature] >= min_reads and covered >= min_covered :
+                rows += [[feature[0], feature[1], self.lengths[feature], self.reads[feature],
+                          self.bases[feature] / self.lengths[feature], covered]]
+        hits = pandas.DataFrame(rows, columns = ['feature_set', 'feature', 'length', 'reads', 'depth', 'covered'])
+        return hits.sort_values(['feature_set', 'depth'], ascending = [True, False]).reset_index(drop = True)
+
+
 def nicenumber(x, round):
     exp = np.floor(np.log10(x))
     f   = x / 10**exp
@@ -93,6 +512,555 @@ def pretty(low, high, n):
     return np.arange(miny, maxy+0.5*d, d)
 
 
+def file_fingerprint(a_file, block_size = 2**24, fingerprints = {}) :
+
+    # Hash every byte; two read sets of the same size can differ anywhere.  Each file is only hashed once per
+    # process, for as long as it's the same file (inode) unchanged (size and mtime).
+    file_stat = os.stat(a_file)
+    memo_key = (os.path.realpath(a_file), file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+    if memo_key in fingerprints :
+        return fingerprints[memo_key]
+
+    fingerprint = hashlib.sha256(str(file_stat.st_size).encode())
+    with open(a_file, 'rb') as file_handle :
+        while True :
+            block = file_handle.read(block_size)
+            if not block :
+                break
+            fingerprint.update(block)
+
+    fingerprints[memo_key] = fingerprint.hexdigest()
+    return fingerprints[memo_key]
+
+
+def link_or_copy(source, destination) :
+
+    # Hardlink when we can (same filesystem), otherwise fall back to a real copy
+    try :
+        os.link(source, destination)
+    except OSError :
+        shutil.copy2(source, destination)
+    return destination
+
+
+def rebase_paths(value, old_prefix, new_prefix) :
+
+    if isinstance(value, str) :
+        if value.startswith(old_prefix) :
+            return new_prefix + value[len(old_prefix):]
+        return value
+    if isinstance(value, list) :
+        return [rebase_paths(i, old_prefix, new_prefix) for i in value]
+    if isinstance(value, dict) :
+        return {name : rebase_paths(i, old_prefix, new_prefix) for name, i in value.items()}
+    if isinstance(value, pandas.Series) and value.dtype == object :
+        return value.map(lambda i : rebase_paths(i, old_prefix, new_prefix))
+    return value
+
+
+def shared_file_lock(a_file) :
+
+    # One lock per shared file (database, index) for everything that might build it
+    with shared_file_locks_lock :
+        if not a_file in shared_file_locks :
+            shared_file_locks[a_file] = threading.Lock()
+        return shared_file_locks[a_file]
+
+
+def is_up_to_date(a_file, source_file) :
+    return os.path.isfile(a_file) and os.path.getmtime(a_file) >= os.path.getmtime(source_file)
+
+
+def path_bytes(value) :
+
+    # Total size of the file(s)/directories an attribute points at; anything else counts as 0
+    if isinstance(value, list) :
+        return sum([path_bytes(i) for i in value])
+    if not isinstance(value, str) :
+        return 0
+    if os.path.isfile(value) :
+        return os.path.getsize(value)
+    if os.path.isdir(value) :
+        return sum([os.path.getsize(os.path.join(root, i)) for root, dirs, files in os.walk(value) for i in files
+                    if os.path.isfile(os.path.join(root, i))])
+    return 0
+
+
+def load_calibration(trace_paths) :
+
+    # Per-step rates (time, disk and memory per input byte) from the traces of earlier runs.  Directories
+    # are searched for trace.jsonl files, so a whole tree of finished runs can be given.
+    trace_files = []
+    for trace_path in trace_paths :
+        if os.path.isdir(trace_path) :
+            trace_files += glob.glob(os.path.join(trace_path, '**', 'trace.jsonl'), recursive = True)
+        else :
+            trace_files += [trace_path]
+
+    step_traces = []
+    for trace_file in trace_files :
+        with open(trace_file) as trace_handle :
+            step_traces += [i for i in [json.loads(line) for line in trace_handle if line.strip()]
+                            if i.get('type') == 'step' and 'input_bytes' in i]
+    if len(step_traces) == 0 :
+        return pandas.DataFrame(columns = ['wall', 'disk_bytes', 'max_rss_kb', 'wall_rate', 'disk_rate', 'rss_rate'])
+
+    step_traces = pandas.DataFrame(step_traces)
+    sized = step_traces['input_bytes'] > 0
+    for column, rate in [('wall', 'wall_rate'), ('disk_bytes', 'disk_rate'), ('max_rss_kb', 'rss_rate')] :
+        step_traces[rate] = numpy.nan
+        step_traces.loc[sized, rate] = step_traces.loc[sized, column] / step_traces.loc[sized, 'input_bytes']
+    return step_traces.groupby('step')[['wall', 'disk_bytes', 'max_rss_kb', 'wall_rate', 'disk_rate', 'rss_rate']].median()
+
+
+def is_bgzf(fastq) :
+
+    # BGZF files are gzip members that say how big they are ('BC' extra subfield), so they can be split
+    # up without inflating them
+    with open(fastq, 'rb') as fastq_handle :
+        header = fastq_handle.read(16)
+    return header[:4] == b'\x1f\x8b\x08\x04' and header[12:16] == b'BC\x02\x00'
+
+
+def bgzf_chunks(fastq, threads, blocks_per_batch = 64) :
+
+    # Inflate batches of BGZF blocks on several threads (zlib lets go of the GIL), in order
+    with open(fastq, 'rb') as fastq_handle, concurrent.futures.ThreadPoolExecutor(max_workers = threads) as executor :
+        while True :
+            blocks = []
+            while len(blocks) < blocks_per_batch * threads :
+                header = fastq_handle.read(12)
+                if len(header) < 12 :
+                    break
+                extra_length = int.from_bytes(header[10:12], 'little')
+                extra = fastq_handle.read(extra_length)
+                block_size = None
+                i = 0
+                while i + 4 <= len(extra) :
+                    subfield_length = int.from_bytes(extra[i + 2:i + 4], 'little')
+                    if extra[i:i + 2] == b'BC' :
+                        block_size = int.from_bytes(extra[i + 4:i + 6], 'little') + 1
+                    i += 4 + subfield_length
+                if block_size is None :
+                    raise ValueError(fastq + ' has a block that isn\'t BGZF')
+                block = fastq_handle.read(block_size - 12 - extra_length)
+                blocks += [block[:-8]]
+            if len(blocks) == 0 :
+                return
+            for chunk in executor.map(lambda i : zlib.decompress(i, -15), blocks) :
+                yield chunk
+
+
+def gzip_chunks(fastq, chunk_size = 2**22) :
+
+    # Plain gzip can't be split, but inflating in a background thread at least overlaps it with the parsing
+    chunks = queue.Queue(maxsize = 16)
+    stop = threading.Event()
+    def put(item) :
+        # Give up once the reader has, rather than wait forever on a full queue
+        while not stop.is_set() :
+            try :
+                chunks.put(item, timeout = 0.1)
+                return True
+            except queue.Full :
+                pass
+        return False
+    def inflate() :
+        try :
+            with open(fastq, 'rb') as fastq_handle :
+                inflater = zlib.decompressobj(31)
+                while True :
+                    data = fastq_handle.read(chunk_size)
+                    if not data :
+                        break
+                    # Concatenated (multi-member) gzip starts over after each member
+                    while data :
+                        if not put(inflater.decompress(data)) :
+                            return
+                        data = inflater.unused_data
+                        if data :
+                            inflater = zlib.decompressobj(31)
+        except Exception as exception :
+            put(exception)
+        put(None)
+    inflate_thread = threading.Thread(target = inflate, daemon = True)
+    inflate_thread.start()
+
+    # However the caller stops (including closing us early), let the inflating thread go
+    try :
+        while True :
+            chunk = chunks.get()
+            if chunk is None :
+                return
+            if isinstance(chunk, Exception) :
+                raise chunk
+            yield chunk
+    finally :
+        stop.set()
+        while inflate_thread.is_alive() :
+            try :
+                chunks.get(timeout = 0.1)
+            except queue.Empty :
+                pass
+
+
+def plain_chunks(fastq, chunk_size = 2**22) :
+    with open(fastq, 'rb') as fastq_handle :
+        while True :
+            chunk = fastq_handle.read(chunk_size)
+            if not chunk :
+                return
+            yield chunk
+
+
+def fastq_chunks(fastq, threads = 1) :
+
+    # The uncompressed FASTQ, a chunk at a time
+    if not re.search('\\.(gz|gzip)$', fastq) :
+        return plain_chunks(fastq)
+    elif threads > 1 and is_bgzf(fastq) :
+        return bgzf_chunks(fastq, threads)
+    else :
+        return gzip_chunks(fastq)
+
+
+def fastq_records(fastq, threads = 1) :
+
+    # (offset, header, sequence, quality) for each read.  Offsets are into the uncompressed FASTQ.
+    chunks = fastq_chunks(fastq, threads)
+
+    def lines() :
+        remainder = b''
+        for chunk in chunks :
+            chunk_lines = (remainder + chunk).split(b'\n')
+            remainder = chunk_lines.pop()
+            yield from chunk_lines
+        if remainder :
+            yield remainder
+
+    # Records are taken four lines at a time, so anything else (e.g., wrapped, multi-line FASTQ) has to be
+    # caught here rather than quietly read as the wrong reads
+    line_iterator = lines()
+    offset = 0
+    for header, sequence, plus, quality in itertools.zip_longest(line_iterator, line_iterator, line_iterator, line_iterator) :
+        if quality is None and header.strip() == b'' : # Blank lines at the end
+            return
+        if quality is None or header[:1] != b'@' or plus[:1] != b'+' or len(sequence) != len(quality) :
+            raise ValueError(fastq + ' has a malformed record at byte ' + str(offset) +
+                             '; only 4-line FASTQ (one line of sequence and one of quality per read) is supported')
+        yield offset, header.rstrip(b'\r'), sequence.rstrip(b'\r'), quality.rstrip(b'\r')
+        offset += len(header) + len(sequence) + len(plus) + len(quality) + 4
+
+
+def fastq_index_file(fastq, index_dir) :
+
+    # Indexes live in a directory of ours, named for the FASTQ's full path, never next to the user's reads
+    fastq_path = os.path.realpath(fastq)
+    return os.path.join(index_dir, hashlib.sha1(fastq_path.encode()).hexdigest()[:16] + '.' +
+                        os.path.basename(fastq_path) + '.pimaidx.npz')
+
+
+def quality_means(qualities) :
+
+    # Mean quality of each of a batch of reads, and a histogram of all of their qualities, in one go
+    values = numpy.frombuffer(b''.join(qualities), dtype = numpy.uint8)
+    lengths = numpy.fromiter((len(i) for i in qualities), dtype = numpy.int64, count = len(qualities))
+    means = numpy.zeros(len(qualities), dtype = numpy.float32)
+    not_empty = lengths > 0
+    if len(values) > 0 :
+        starts = (numpy.cumsum(lengths) - lengths)[not_empty]
+        means[not_empty] = numpy.add.reduceat(values, starts, dtype = numpy.int64) / lengths[not_empty] - 33
+    return means, numpy.bincount(values, minlength = 128)[:128]
+
+
+def fastq_index(fastq, threads = 1, index_dir = None, quality_chunk_size = 2**26) :
+
+    # Offset, length and mean quality of every read.  Given a directory, it's kept there so later steps and
+    # reruns can skip the scan; it's only reused if the FASTQ's size and mtime still match.
+    fastq_stat = os.stat(fastq)
+    index_file = fastq_index_file(fastq, index_dir) if index_dir else None
+    if index_file :
+        os.makedirs(index_dir, exist_ok = True)
+    with shared_file_lock(index_file or fastq) :
+        if index_file and os.path.isfile(index_file) :
+            try :
+                with numpy.load(index_file) as saved_index :
+                    if saved_index['size'] == fastq_stat.st_size and saved_index['mtime'] == fastq_stat.st_mtime :
+                        return {i : saved_index[i] for i in saved_index.files}
+            except (OSError, ValueError, KeyError) :
+                pass
+
+        offsets, lengths, mean_qualities = array.array('q'), array.array('l'), []
+        quality_histogram = numpy.zeros(128, dtype = numpy.int64)
+        qualities, qualities_size = [], 0
+        for offset, header, sequence, quality in fastq_records(fastq, threads) :
+            offsets.append(offset)
+            lengths.append(len(sequence))
+
+            # Qualities are averaged and counted in big chunks rather than read by read
+            qualities += [quality]
+            qualities_size += len(quality)
+            if qualities_size >= quality_chunk_size :
+                chunk_means, chunk_histogram = quality_means(qualities)
+                mean_qualities += [chunk_means]
+                quality_histogram += chunk_histogram
+                qualities, qualities_size = [], 0
+        if len(qualities) > 0 :
+            chunk_means, chunk_histogram = quality_means(qualities)
+            mean_qualities += [chunk_means]
+            quality_histogram += chunk_histogram
+
+        index = {'size' : numpy.int64(fastq_stat.st_size),
+                 'mtime' : numpy.float64(fastq_stat.st_mtime),
+                 'offsets' : numpy.frombuffer(offsets, dtype = numpy.int64),
+                 'lengths' : numpy.array(lengths, dtype = numpy.int64),
+                 'mean_qualities' : numpy.concatenate(mean_qualities) if len(mean_qualities) > 0 else numpy.zeros(0, dtype = numpy.float32),
+                 'quality_histogram' : quality_histogram[33:]}
+
+        if index_file :
+            with open(index_file + '.tmp', 'wb') as index_handle :
+                numpy.savez(index_handle, **index)
+            os.replace(index_file + '.tmp', index_file)
+        return index
+
+
+def pack_kmers(codes, k) :
+
+    # 2-bit packed k-mer starting at each position, built by doubling (1, 2, 4, ... -mers) rather than base by base
+    packed, packed_length = None, 0
+    block, block_length = codes, 1
+    while k > 0 :
+        if k & 1 :
+            if packed is None :
+                packed, packed_length = block, block_length
+            else :
+                packed = (packed[:len(block) - packed_length] << numpy.uint64(2 * block_length)) | block[packed_length:]
+                packed_length += block_length
+        k >>= 1
+        if k > 0 :
+            block = (block[:-block_length] << numpy.uint64(2 * block_length)) | block[block_length:]
+            block_length *= 2
+    return packed[:len(codes) - packed_length + 1]
+
+
+def kmer_genome_size(read_set, threads = 1, k = 17, scale = 200, batch_size = 2**24, block_size = 2**18) :
+
+    # Genome size from the number of solid (i.e., not just sequencing error) canonical k-mers in the reads,
+    # counted for a 1/scale hash sample of them (FracMinHash) so the counts stay small
+    base_codes = numpy.full(256, 4, dtype = numpy.uint8)
+    for bases, code in [(b'Aa', 0), (b'Cc', 1), (b'Gg', 2), (b'Tt', 3)] :
+        base_codes[list(bases)] = code
+    max_hash = numpy.uint64(2**64 // scale)
+
+    def sample_block(codes) :
+
+        n_count = numpy.concatenate([[0], numpy.cumsum(codes == 4, dtype = numpy.int32)])
+        valid = (n_count[k:] - n_count[:-k]) == 0
+
+        codes = (codes & 3).astype(numpy.uint64)
+        forward = pack_kmers(codes, k)
+        reverse = pack_kmers((numpy.uint64(3) - codes)[::-1], k)[::-1]
+        hashes = numpy.minimum(forward, reverse)[valid] * numpy.uint64(0x9E3779B97F4A7C15)
+        hashes ^= hashes >> numpy.uint64(29)
+        return hashes[hashes < max_hash]
+
+    def sample_batch(sequences) :
+
+        # Reads are joined with an N between them, so no k-mer spans two reads.  The k-mers are packed a
+        # block at a time (overlapping by k - 1) so the 64-bit intermediates stay small.
+        codes = base_codes[numpy.frombuffer(b'N'.join(sequences), dtype = numpy.uint8)]
+        sampled = [sample_block(codes[i:i + block_size + k - 1]) for i in range(0, len(codes) - k + 1, block_size)]
+        return numpy.concatenate(sampled) if len(sampled) > 0 else numpy.zeros(0, dtype = numpy.uint64)
+
+    def batches() :
+        nonlocal bases
+        sequences, sequences_size = [], 0
+        for offset, header, sequence, quality in read_set_records(read_set, threads) :
+            bases += len(sequence)
+            sequences += [sequence]
+            sequences_size += len(sequence)
+            if sequences_size >= batch_size :
+                yield sequences
+                sequences, sequences_size = [], 0
+        if sequences_size > 0 :
+            yield sequences
+
+    # Batches are hashed on several threads (numpy lets go of the GIL), one more than there are threads at a
+    # time, and smaller the more threads there are, so the reads held in memory don't grow with the threads.
+    # The sampled hashes are merged into the counts whenever there are about as many new ones as counted ones.
+    batch_size = max(block_size, batch_size // threads)
+    bases = 0
+    kmers, kmer_counts = numpy.zeros(0, dtype = numpy.uint64), numpy.zeros(0, dtype = numpy.int64)
+    new_hashes, new_hashes_size = [], 0
+    running = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as executor :
+        for batch in itertools.chain(batches(), [None]) :
+            if batch is not None :
+                running += [executor.submit(sample_batch, batch)]
+                if len(running) <= threads :
+                    continue
+            while len(running) > (threads if batch is not None else 0) :
+                new_hashes += [running.pop(0).result()]
+                new_hashes_size += len(new_hashes[-1])
+
+            if new_hashes_size > len(kmers) or (batch is None and new_hashes_size > 0) :
+                new_hashes = numpy.concatenate(new_hashes)
+                kmers, inverse = numpy.unique(numpy.concatenate([kmers, new_hashes]), return_inverse = True)
+                kmer_counts = numpy.bincount(inverse, weights = numpy.concatenate([kmer_counts, numpy.ones(len(new_hashes))])).astype(numpy.int64)
+                new_hashes, new_hashes_size = [], 0
+
+    if len(kmer_counts) == 0 :
+        return 0, 0
+
+    # Error k-mers are rare, so solid ones start where the multiplicity histogram turns back up
+    count_histogram = numpy.bincount(kmer_counts)
+    solid_min = 2
+    for i in range(2, len(count_histogram) - 1) :
+        if count_histogram[i + 1] > count_histogram[i] :
+            solid_min = i
+            break
+
+    genome_size = int((kmer_counts >= solid_min).sum()) * scale
+    return genome_size, bases / genome_size if genome_size > 0 else 0
+
+
+def read_watch_journal(journal_file) :
+
+    # The batches an interrupted --ont-watch finished, one JSON record per line.  A line cut short by the
+    # interruption is the end of the journal, and is cut off so new records can be appended after it.
+    batches = []
+    if not os.path.isfile(journal_file) :
+        return batches
+    journal_bytes = 0
+    with open(journal_file, 'rb') as journal_handle :
+        for line in journal_handle :
+            if not line.endswith(b'\n') :
+                break
+            try :
+                batches += [json.loads(line)]
+            except ValueError :
+                break
+            journal_bytes += len(line)
+    os.truncate(journal_file, journal_bytes)
+    return batches
+
+
+def histogram_n50(length_histogram) :
+
+    # N50 from a read-length histogram: walk the lengths from the longest down until half the bases are covered
+    bases_by_length = numpy.arange(len(length_histogram)) * length_histogram
+    bases = bases_by_length.sum()
+    if bases == 0 :
+        return 0
+    longest_first_bases = numpy.cumsum(bases_by_length[::-1])
+    return len(length_histogram) - 1 - int(numpy.argmax(longest_first_bases > bases / 2))
+
+
+def add_histograms(histogram_1, histogram_2) :
+    if len(histogram_1) < len(histogram_2) :
+        histogram_1, histogram_2 = histogram_2, histogram_1
+    histogram_1 = histogram_1.copy()
+    histogram_1[:len(histogram_2)] += histogram_2
+    return histogram_1
+
+
+def fasta_to_fastq(fasta, fastq, quality = 25, chunk_size = 2**22) :
+
+    # Give every base the same quality, with one quality string sliced per read rather than anything per base.
+    # Writes gzip (quickly, at level 1) if the FASTQ's name ends in .gz.
+    quality_char = bytes([33 + quality])
+    qualities = quality_char * 2**16
+    if fastq.endswith('.gz') :
+        fastq_handle = gzip.open(fastq, 'wb', compresslevel = 1)
+    else :
+        fastq_handle = open(fastq, 'wb', buffering = chunk_size)
+
+    def write_read(name, sequence_lines) :
+        nonlocal qualities
+        sequence = b''.join(sequence_lines)
+        if len(sequence) > len(qualities) :
+            qualities = quality_char * (2 * len(sequence))
+        fastq_handle.write(b'@' + name + b'\n' + sequence + b'\n+\n')
+        fastq_handle.write(memoryview(qualities)[:len(sequence)])
+        fastq_handle.write(b'\n')
+
+    with open(fasta, 'rb', buffering = chunk_size) as fasta_handle, fastq_handle :
+        name, sequence_lines = None, []
+        for line in fasta_handle :
+            line = line.rstrip(b'\r\n')
+            if line.startswith(b'>') :
+                if name is not None :
+                    write_read(name, sequence_lines)
+                name, sequence_lines = line[1:], []
+            elif name is not None :
+                sequence_lines += [line]
+        if name is not None :
+            write_read(name, sequence_lines)
+
+
+def read_set_files(read_set) :
+
+    # A read set is one FASTQ or a list of them (e.g., guppy's chunks), used as one set of reads
+    if isinstance(read_set, (list, tuple)) :
+        return list(read_set)
+    return [read_set]
+
+
+def read_set_label(read_set) :
+
+    # One line for the report however many chunks there are, e.g., the directory guppy wrote them to
+    fastqs = read_set_files(read_set)
+    if len(fastqs) == 1 :
+        return fastqs[0]
+    return os.path.commonpath(fastqs) + ' (' + str(len(fastqs)) + ' FASTQ files)'
+
+
+def read_set_arg(read_set) :
+
+    # For tools that take several read files, e.g., minimap2 and flye
+    return ' '.join(read_set_files(read_set))
+
+
+def read_set_records(read_set, threads = 1) :
+    return itertools.chain.from_iterable([fastq_records(fastq, threads) for fastq in read_set_files(read_set)])
+
+
+def expand_read_set(path) :
+
+    # A FASTQ, a directory of (possibly gzipped) FASTQ chunks, or a glob of them
+    if os.path.isfile(path) :
+        return path
+    if os.path.isdir(path) :
+        fastqs = [i for pattern in ['*.fastq', '*.fq', '*.fastq.gz', '*.fq.gz'] for i in glob.glob(os.path.join(path, pattern))]
+    else :
+        fastqs = glob.glob(path)
+    fastqs = sorted(set(fastqs))
+    if len(fastqs) == 1 :
+        return fastqs[0]
+    return fastqs
+
+
+def fastq_stats(fastqs, threads = 1, index_dir = None) :
+
+    # Read statistics from the FASTQs' indexes.  N50 comes from a length histogram, not a sort.
+    indexes = [fastq_index(fastq, threads, index_dir) for fastq in fastqs]
+    lengths = numpy.concatenate([i['lengths'] for i in indexes])
+    quality_histogram = sum([i['quality_histogram'] for i in indexes])
+    length_histogram = numpy.bincount(lengths) if len(lengths) > 0 else numpy.zeros(1, dtype = numpy.int64)
+
+    read_count = len(lengths)
+    bases = int(lengths.sum())
+    n50 = histogram_n50(length_histogram)
+
+    return {'read_count' : read_count,
+            'bases' : bases,
+            'mean_length' : bases / read_count if read_count > 0 else 0,
+            'n50' : n50,
+            'mean_quality' : (numpy.arange(len(quality_histogram)) * quality_histogram).sum() / max(1, quality_histogram.sum()),
+            'length_histogram' : length_histogram,
+            'quality_histogram' : quality_histogram}
+
+
 def format_kmg(number, decimals = 0) :
 
     if number == 0 :
@@ -111,6 +1079,7 @@ class Analysis :
 
     def __init__(self, opts, unknown_args) :
 
+        self.opts = opts
         self.input_given = []
 
         # Date-time information
@@ -126,6 +1095,11 @@ class Analysis :
         self.ont_watch_time_max = opts.ont_watch_max_time * 60 * 60
         self.ont_watch_between_max = opts.ont_watch_between_time * 60
         self.ont_watch_sleep_time = 10
+        self.ont_watch_batch_files = opts.ont_watch_batch_files
+        self.ont_watch_depth = opts.ont_watch_depth
+        self.ont_watch_n50 = opts.ont_watch_n50
+        self.ont_watch_batch_time = opts.ont_watch_batch_time * 60
+        self.ont_watch_provisional = opts.ont_watch_provisional * 60 if opts.ont_watch_provisional else None
         
         self.ont_fast5 = opts.ont_fast5
         self.ont_fast5_limit = opts.ont_fast5_limit
@@ -148,15 +1122,27 @@ class Analysis :
         
         self.output_dir = opts.output
         self.overwrite = opts.overwrite
+        self.resume = opts.resume
+        self.state_file = None
+        self.cache_dir = opts.cache_dir
 
         # Assembly options
         self.assembler = opts.assembler
         self.genome_assembly_size = opts.genome_size
         self.racon = opts.racon
         self.racon_rounds = opts.racon_rounds
+        self.racon_keep_paf = opts.racon_keep_paf
         self.no_medaka = opts.no_medaka
         self.ont_n50 = None
         self.ont_n50_min = 2500
+
+        # Target ONT depth for the steps that map reads; those without one get every read
+        self.ont_depths = {'racon_ont_assembly' : opts.racon_depth,
+                           'medaka_ont_assembly' : opts.medaka_depth,
+                           'assembly_info' : opts.info_depth,
+                           'call_amr_mutations' : opts.mutation_depth}
+        self.ont_fastq_subsets = {}
+        self.ont_fastq_subset_scales = {} # All of the bases over the subset's
         self.ont_coverage_min = 30
         self.illumina_length_mean = None
         self.illumina_coverage_min = 30
@@ -188,6 +1174,8 @@ class Analysis :
 
         self.feature_fastas = opts.feature
         self.feature_hits = pandas.Series()
+        self.read_screen = opts.read_screen
+        self.read_screen_hits = None
         self.feature_dirs = []
         self.feature_names = []
         self.feature_colors = []
@@ -203,6 +1191,16 @@ class Analysis :
         self.amr_deletions = pandas.DataFrame()
         
         self.threads = opts.threads
+        self.max_parallel_steps = opts.max_parallel_steps
+        self.thread_budget = ThreadBudget(self.threads)
+        self.stream_reads = opts.stream_reads
+        self.read_fanouts = {}
+
+        # The commands each running step has going, so they can be stopped if another step errors out
+        self.step_processes = {}
+
+        # What the attributes each running step has changed looked like before it started (see save_state())
+        self.running_step_states = {}
 
         self.errors = []
         self.warnings = []
@@ -212,9 +1210,15 @@ class Analysis :
 
         # Files to remove when done
         self.files_to_clean = []
+
+        # Time and resources used by each command and step, written to trace.jsonl
+        self.trace = []
+        self.trace_file = None
         
-        # Don't actully run any commands
+        # Don't actully run any commands, just plan the run using traces from earlier runs
         self.fake_run = opts.fake_run
+        self.calibration = opts.calibration
+        self.plan_json = opts.plan_json
 
         # Reporting
         self.bundle = opts.bundle
@@ -290,32 +1294,154 @@ class Analysis :
 
         # The actual steps to carry out in the analysis held as a list
         self.analysis = []
+
+        # Steps finished so far, and any plans that steps replaced self.analysis with, for --resume
+        self.finished_steps = []
+        self.plan_rewrites = {}
+        self.produced_attributes = set()
         
         # See if we got any unknown args.  Not allowed.
         if len(unknown_args) != 0 :
             self.errors = self.errors + ['Unknown argument: ' + unknown for unknown in unknown_args]
                                            
 
+    def __setattr__(self, name, value) :
+
+        # Keep track of the attributes each step sets so they can be cached
+        written = getattr(step_context, 'written', None)
+        if written is not None :
+            written.add(name)
+        object.__setattr__(self, name, value)
+
+
+    def __getstate__(self) :
+
+        # Pool workers can't share the open log, or the threads feeding read pipes
+        state = self.__dict__.copy()
+        state['logging_handle'] = None
+        state['read_fanouts'] = {}
+        state['step_processes'] = {}
+        state['running_step_states'] = {}
+        return state
+
+
     def print_and_log(self, text, verbosity, color = Colors.ENDC) :
+        time_string = '[' + str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + ']'
         if verbosity <= self.verbosity :
-            time_string = '[' + str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + ']'
             print(time_string + ' ' + color + text + Colors.ENDC)
         if self.logging_handle :
-            self.logging_handle.write(time_string + ' ' + text)
+            self.logging_handle.write(time_string + ' ' + text + '\n')
+            self.logging_handle.flush()
+
+
+    def add_trace(self, record) :
+
+        record['step'] = getattr(step_context, 'step', None)
+        with trace_lock :
+            self.trace += [record]
+            if self.trace_file :
+                with open(self.trace_file, 'a') as trace_handle :
+                    trace_handle.write(json.dumps(record) + '\n')
 
             
-    def run_command(self, command) :
+    def run_command(self, command, consumer = None, output_file = None, max_lines = None, tee_stderr = False) :
+
+        # Output is read a line at a time, so only what the caller asks to keep is held in memory.  Lines go to
+        # the consumer callback or output file if given, otherwise (up to max_lines of them) back to the caller.
         if not self.fake_run :
-            try : 
-                return(re.split('\\n', subprocess.check_output(command, shell = True).decode('utf-8')))
+            start_time = time.time()
+            lines = []
+            output_handle = None
+            stderr_thread = None
+            step = getattr(step_context, 'step', None)
+            try :
+                # Each command gets its own process group so that everything it starts can be stopped together
+                process = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE,
+                                           stderr = subprocess.PIPE if tee_stderr else None,
+                                           start_new_session = step is not None)
+                if step is not None :
+                    self.step_processes.setdefault(step, set()).add(process)
+
+                if tee_stderr :
+                    stderr_thread = threading.Thread(target = self.tee_stream, args = (process.stderr,))
+                    stderr_thread.start()
+
+                if output_file :
+                    output_handle = open(output_file, 'wb')
+                    shutil.copyfileobj(process.stdout, output_handle)
+                else :
+                    for line in process.stdout :
+                        line = line.decode('utf-8', errors = 'replace').rstrip('\n')
+                        if consumer :
+                            consumer(line)
+                        elif max_lines is None or len(lines) < max_lines :
+                            lines += [line]
+                        # Past max_lines we keep reading so the command isn't killed by a closed pipe
+                process.stdout.close()
+
+                # Reap the shell ourselves so we get its (and its children's) resource usage.  Linux carries
+                # the forking process's peak RSS over to the child, so max RSS never reads below our own size.
+                pid, status, usage = os.wait4(process.pid, 0)
+                if os.WIFSIGNALED(status) :
+                    process.returncode = -os.WTERMSIG(status)
+                else :
+                    process.returncode = os.WEXITSTATUS(status)
             except :
                 self.print_and_log('Command ' + command + ' failed; exiting', 0, Colors.FAIL)
                 self.error_out()
+            finally :
+                if output_handle :
+                    output_handle.close()
+                if stderr_thread :
+                    stderr_thread.join()
+                if step is not None :
+                    self.step_processes.get(step, set()).discard(process)
+
+            if getattr(step_context, 'step', None) :
+                step_context.max_rss_kb = max(step_context.max_rss_kb, usage.ru_maxrss)
+            self.add_trace({'type' : 'command',
+                            'command' : command,
+                            'start' : start_time,
+                            'wall' : time.time() - start_time,
+                            'user' : usage.ru_utime,
+                            'sys' : usage.ru_stime,
+                            'max_rss_kb' : usage.ru_maxrss,
+                            'read_bytes' : usage.ru_inblock * 512,
+                            'write_bytes' : usage.ru_oublock * 512,
+                            'exit' : process.returncode})
+
+            if process.returncode != 0 :
+                self.print_and_log('Command ' + command + ' failed; exiting', 0, Colors.FAIL)
+                self.error_out()
+
+            if len(lines) == 0 :
+                lines = ['']
+            return(lines)
+
+
+    def tee_stream(self, stream) :
+
+        for line in stream :
+            self.print_and_log(line.decode('utf-8', errors = 'replace').rstrip('\n'), self.command_verbosity)
+        stream.close()
 
             
-    def print_and_run(self, command) :
+    def print_and_run(self, command, consumer = None, output_file = None, max_lines = None, tee_stderr = False) :
         self.print_and_log(command, self.command_verbosity)
-        return(self.run_command(command))
+        return(self.run_command(command, consumer = consumer, output_file = output_file, max_lines = max_lines,
+                                tee_stderr = tee_stderr))
+
+
+    def probe_version(self, command, max_lines = 1) :
+
+        # --fake-run runs nothing, but still has to get through validation to plan the analysis
+        if self.fake_run :
+            return(['0.0'] * max_lines)
+
+        # Tool versions don't change during a run, so every analysis shares the first answer
+        if not command in version_probes :
+            version_probes[command] = self.print_and_run(command, max_lines = max_lines)
+        return(version_probes[command])
 
 
     def print_warning(self, warning) :
@@ -384,6 +1510,19 @@ class Analysis :
 
         finish_file = os.path.join(a_dir, '.finish')
         self.touch_file(finish_file)
+
+
+    def has_valid_finish_file(self, a_dir) :
+
+        start_file, finish_file = [os.path.join(a_dir, i) for i in ['.start', '.finish']]
+        if not self.validate_file(finish_file) :
+            return False
+
+        # A .start newer than the .finish means the step was started again and didn't finish
+        if self.validate_file(start_file) and os.path.getmtime(start_file) > os.path.getmtime(finish_file) :
+            return False
+
+        return True
     
         
     def load_fasta(self, fasta) :
@@ -459,7 +1598,7 @@ class Analysis :
             bwa_stdout, bwa_stderr = self.std_files(std_prefix + '_aln')
             this_sai = std_prefix + '_aln_' + str(i) + '.sai'
             command = ' '.join(['bwa aln',
-                                '-t', str(self.threads),
+                                '-t', self.step_threads(),
                                 genome,
                                 self.illumina_fastq[i],
                                 '1>', this_sai,
@@ -491,20 +1630,49 @@ class Analysis :
         self.index_bam(bam)
 
 
+    def merged_fastq(self, read_set) :
+
+        # Tools that take only one reads file get the read set merged, once, for every step that needs it
+        fastqs = read_set_files(read_set)
+        if len(fastqs) == 1 :
+            return fastqs[0]
+
+        all_gzipped = all([i.endswith('.gz') for i in fastqs])
+        merged_dir = os.path.join(self.output_dir, 'read_sets')
+        os.makedirs(merged_dir, exist_ok = True)
+        merged_fastq = os.path.join(merged_dir, hashlib.sha1('\n'.join(fastqs).encode()).hexdigest()[:16] +
+                                    ('.fastq.gz' if all_gzipped else '.fastq'))
+
+        with shared_file_lock(merged_fastq) :
+            if not all([is_up_to_date(merged_fastq, i) for i in fastqs]) :
+                self.print_and_log('Merging ' + str(len(fastqs)) + ' FASTQ files for a tool that needs one',
+                                   self.sub_process_verbosity, self.sub_process_color)
+
+                # gzip members concatenate into valid gzip; a mix gets decompressed
+                merge = 'cat' if all_gzipped or not any([i.endswith('.gz') for i in fastqs]) else 'gzip -dcf'
+                command = ' '.join([merge, ' '.join(fastqs), '>', merged_fastq + '.tmp'])
+                self.print_and_run(command)
+                if not self.fake_run :
+                    os.replace(merged_fastq + '.tmp', merged_fastq)
+                if not merged_fastq in self.files_to_clean :
+                    self.files_to_clean += [merged_fastq]
+        return merged_fastq
+
+
     def minimap_ont_fastq(self, genome, fastq, bam) :
 
         std_prefix = re.sub('\.bam$', '', bam)
         minimap_stdout, minimap_stderr = self.std_files(std_prefix)
         command = ' '.join(['minimap2 -a',
-                            '-t', str(self.threads),
+                            '-t', self.step_threads(),
                             '-x map-ont',
                             genome,
-                            fastq,
+                            read_set_arg(fastq),
                             '2>' + minimap_stderr,
                             '| samtools sort',
-                            '-@', str(self.threads),
+                            '-@', self.step_threads(0.25),
                             '-o', bam,
-                            '-T reads.tmp -',
+                            '-T', std_prefix + '.tmp', '-',
                             '1>/dev/null 2>/dev/null'])
         self.print_and_run(command)
         self.validate_file_and_size_or_error(bam)
@@ -516,15 +1684,15 @@ class Analysis :
         std_prefix = re.sub('\.bam$', '', bam)
         minimap_stdout, minimap_stderr = self.std_files(std_prefix)
         command = ' '.join(['minimap2 -a',
-                            '-t', str(self.threads),
+                            '-t', self.step_threads(),
                             '-x sr',
                             genome,
                             ' '.join(fastq),
                             '2>' + minimap_stderr,
                             '| samtools sort',
-                            '-@', str(self.threads),
+                            '-@', self.step_threads(0.25),
                             '-o', bam,
-                            '-T reads.tmp -',
+                            '-T', std_prefix + '.tmp', '-',
                             '1>/dev/null 2>/dev/null'])
         self.print_and_run(command)
         self.validate_file_and_size_or_error(bam)
@@ -604,6 +1772,15 @@ class Analysis :
         if self.ont_watch_reads_min < 0 :
             self.errors += ['ONT watch min reads must be > 0.']
 
+        if (self.ont_watch_depth or self.ont_watch_n50) and not self.genome_assembly_size :
+            self.errors += ['--ont-watch-depth and --ont-watch-n50 need --genome-size to measure depth.']
+
+        if self.ont_watch_provisional :
+            if self.multiplexed :
+                self.errors += ['--ont-watch-provisional can\'t be used with --multiplexed.']
+            for utility in ['minimap2', 'miniasm', 'racon'] :
+                self.validate_utility(utility, utility + ' is not on the PATH (required by --ont-watch-provisional)')
+
         self.will_have_ont_fastq = True
     
         self.analysis += ['watch_ont']
@@ -655,8 +1832,13 @@ class Analysis :
 
         self.print_and_log('Validating ONT FASTQ', self.main_process_verbosity, self.main_process_color)
 
-        if not os.path.isfile(self.ont_fastq) :
-            self.errors += ['Input ONT FASTQ file ' + self.ont_fastq + ' cannot be found']
+        # Barcodes and provisional analyses are handed read sets that are already expanded
+        if isinstance(self.ont_fastq, str) :
+            read_set = expand_read_set(self.ont_fastq)
+            if len(read_set) == 0 :
+                self.errors += ['Input ONT FASTQ ' + self.ont_fastq + ' cannot be found']
+            else :
+                self.ont_fastq = self.ont_raw_fastq = read_set
 
         self.will_have_ont_fastq = True
 
@@ -678,10 +1860,12 @@ class Analysis :
 
     def validate_output_dir(self) :
     
-        if not opts.output :
+        if not self.output_dir :
             self.errors += ['No output directory given (--output)']
-        elif self.output_dir and os.path.isdir(self.output_dir) and not self.overwrite :
-            self.errors += ['Output directory ' + self.output_dir + ' already exists.  Add --overwrite to ignore']
+        elif self.resume and self.overwrite :
+            self.errors += ['--resume and --overwrite are mutually exclusive.']
+        elif os.path.isdir(self.output_dir) and not (self.overwrite or self.resume) :
+            self.errors += ['Output directory ' + self.output_dir + ' already exists.  Add --overwrite to ignore or --resume to continue']
 
         self.analysis = ['make_output_dir'] + self.analysis
 
@@ -701,7 +1885,7 @@ class Analysis :
 
         if self.validate_utility('guppy_basecaller', 'guppy_basecaller is not on the PATH.') :
             command = 'guppy_basecaller --version'
-            self.versions['guppy'] = re.search('[0-9]+\\.[0-9.]+', self.print_and_run(command)[0]).group(0)
+            self.versions['guppy'] = re.search('[0-9]+\\.[0-9.]+', self.probe_version(command)[0]).group(0)
 
         for utility in ['guppy_aligner', 'guppy_barcoder'] :
             self.validate_utility(utility, utility + ' is not on the PATH.')
@@ -727,7 +1911,7 @@ class Analysis :
 
         if self.validate_utility('qcat', 'qcat is not on the PATH.') :
             command = 'qcat --version'
-            self.versions['qcat'] = re.search('[0-9]+\\.[0-9.]+', self.print_and_run(command)[0]).group(0)
+            self.versions['qcat'] = re.search('[0-9]+\\.[0-9.]+', self.probe_version(command)[0]).group(0)
         
         self.analysis += ['qcat_ont_fastq']
 
@@ -755,6 +1939,35 @@ class Analysis :
 
         self.analysis += ['lorma_ont_fastq']
 
+
+    @unless_only_basecall
+    def validate_subsample_ont_fastq(self) :
+
+        if all([i is None for i in self.ont_depths.values()]) :
+            return
+
+        if not self.will_have_ont_fastq :
+            self.errors += ['Per-step ONT depths (e.g., --racon-depth) require --ont-fast5 and/or --ont-fastq']
+            return
+
+        if not (self.genome_assembly_size or self.organism or self.reference_fasta) :
+            self.require_genome_size_estimate()
+
+        self.analysis += ['subsample_ont_fastq']
+
+
+    def require_genome_size_estimate(self) :
+
+        # The barcodes of multiplexed reads each estimate their own
+        if self.multiplexed or 'estimate_genome_size' in self.analysis :
+            return
+
+        # Alongside the read stats, ahead of anything that needs the size
+        if 'ont_fastq_info' in self.analysis :
+            self.analysis.insert(self.analysis.index('ont_fastq_info') + 1, 'estimate_genome_size')
+        else :
+            self.analysis += ['estimate_genome_size']
+
         
     @unless_only_basecall
     @unless_given_genome
@@ -793,7 +2006,7 @@ class Analysis :
         self.print_and_log('Validating wtdbg2 utilities', self.main_process_verbosity, self.main_process_color)
         
         if not self.genome_assembly_size :
-            self.errors += ['wtdbg2 requires --genome-size']
+            self.require_genome_size_estimate()
         elif not re.match('[0-9]+(\\.[0-9]+)?[mkMK]', self.genome_assembly_size) :
             self.errors += ['--genome-size needs to be a floating point number in Mega or kilobases, got ' + str(self.genome_assembly_size)]
         
@@ -820,13 +2033,13 @@ class Analysis :
         self.print_and_log('Validating flye utilities', self.main_process_verbosity, self.main_process_color)
         
         if not self.genome_assembly_size :
-            self.errors += ['Flye requires --genome-size']
+            self.require_genome_size_estimate()
         elif not re.match('^[0-9]+(\\.[0-9]+)?[mkMK]$', self.genome_assembly_size) :
             self.errors += ['--genome-size needs to be a floating point number in Mega or kilobases, got ' + str(self.genome_assembly_size)]
             
         if self.validate_utility('flye', 'flye is not on the PATH (required by --assembler flye).') :
             command = 'flye --version'
-            self.versions['flye'] = re.search('[0-9]+\\.[0-9.]+', self.print_and_run(command)[0]).group(0)
+            self.versions['flye'] = re.search('[0-9]+\\.[0-9.]+', self.probe_version(command)[0]).group(0)
             
         self.will_have_ont_assembly = True
         self.will_have_genome_fasta = True
@@ -848,7 +2061,7 @@ class Analysis :
         
         if self.validate_utility('racon', 'racon' + ' is not on the PATH (required by --assembler ' + self.assembler +')') :
             command = 'racon --version'
-            self.versions['racon'] = re.search('[0-9]+\\.[0-9.]+', self.print_and_run(command)[0]).group(0)
+            self.versions['racon'] = re.search('[0-9]+\\.[0-9.]+', self.probe_version(command)[0]).group(0)
         
         self.analysis += ['racon_ont_assembly']
 
@@ -870,7 +2083,7 @@ class Analysis :
 
         if self.validate_utility('medaka_consensus', 'medaka_consensus is not on the PATH (required by --medaka)') :
             command = 'medaka --version'
-            self.versions['medaka'] = re.search('[0-9]+\\.[0-9.]+', self.print_and_run(command)[0]).group(0)
+            self.versions['medaka'] = re.search('[0-9]+\\.[0-9.]+', self.probe_version(command)[0]).group(0)
 #            command = 'medaka tools list_models'
 #            models, default = self.print_and_run_command(command)[[0,1]]
 #            print(models)
@@ -949,7 +2162,7 @@ class Analysis :
         for utility in ['minimap2', 'pilon'] :
             if self.validate_utility(utility, utility + ' is not on the PATH (required by --illumina-fastq).') :
                 command = utility + ' --version'
-                self.versions[utility] = re.search('[0-9]+\\.[0-9.]+', self.print_and_run(command)[0]).group(0)
+                self.versions[utility] = re.search('[0-9]+\\.[0-9.]+', self.probe_version(command)[0]).group(0)
 
         self.analysis += ['pilon_assembly']
 
@@ -966,7 +2179,7 @@ class Analysis :
 
         if self.validate_utility('spades.py', 'spades.py is not on the PATH (required by --illumina-fastq)') :
             command = 'spades.py --version'
-            self.versions['spades'] = re.search('[0-9]+\\.[0-9.]+', self.print_and_run(command)[0]).group(0)
+            self.versions['spades'] = re.search('[0-9]+\\.[0-9.]+', self.probe_version(command)[0]).group(0)
                 
         self.analysis += ['spades_illumina_fastq']
         self.will_have_genome_fasta = True
@@ -1035,6 +2248,40 @@ class Analysis :
                     self.errors += ['Can\'t find feature database ' + feature_fasta]
 
 
+    @unless_only_basecall
+    def validate_read_screen(self) :
+
+        if not self.read_screen :
+            return
+
+        if len(self.feature_fastas) == 0 :
+            return
+
+        if not self.will_have_ont_fastq :
+            self.errors += ['--read-screen needs ONT reads.']
+            return
+
+        # Barcodes each screen their own reads
+        if self.multiplexed :
+            return
+
+        self.print_and_log('Validating read screen utilities', self.main_process_verbosity, self.main_process_color)
+
+        if self.validate_utility('minimap2', 'minimap2 is not on the PATH (required by --read-screen)') :
+            command = 'minimap2 --version'
+            self.versions['minimap2'] = re.search('[0-9]+\\.[0-9.]+', self.probe_version(command)[0]).group(0)
+
+        # A watch screens each batch as it comes in
+        if self.ont_watch :
+            return
+
+        # Alongside the read stats, so the answer comes well ahead of the assembly
+        if 'ont_fastq_info' in self.analysis :
+            self.analysis.insert(self.analysis.index('ont_fastq_info') + 1, 'screen_ont_reads')
+        else :
+            self.analysis += ['screen_ont_reads']
+
+
     @unless_only_basecall
     def validate_blast(self) :
 
@@ -1049,7 +2296,7 @@ class Analysis :
         for utility in ['makeblastdb', 'blastn', 'bedtools'] :
             if self.validate_utility(utility, utility + ' isn\'t on the PATH.') :
                 command = utility + ' -version'
-                self.versions[utility] = re.search('[0-9]+\\.[0-9.]+', self.print_and_run(command)[0]).group(0)
+                self.versions[utility] = re.search('[0-9]+\\.[0-9.]+', self.probe_version(command)[0]).group(0)
                 
         self.analysis += ['blast_feature_sets']
 
@@ -1074,7 +2321,11 @@ class Analysis :
                 
             if self.validate_utility('dnadiff', 'dnadiff is not on the PATH.') :
                 command = 'dnadiff -version 2>&1'
-                self.versions['dnadiff'] = re.search('[0-9]+\\.[0-9.]*', self.print_and_run(command)[1]).group(0)
+                self.versions['dnadiff'] = re.search('[0-9]+\\.[0-9.]*', self.probe_version(command, max_lines = 2)[1]).group(0)
+
+            if self.validate_utility('quast.py', 'quast.py is not on the PATH.') :
+                command = 'quast.py --version'
+                self.versions['quast'] = re.search('[0-9]+\\.[0-9.]*', self.probe_version(command)[0]).group(0)
             
             #2 - Check for the reference sequence either as given or in the organism dir
             if self.organism :
@@ -1152,7 +2403,7 @@ class Analysis :
             self.validate_utility(utility, utility + ' is not on the PATH (required for AMR mutations)')
 
             command = utility + ' --version'
-            self.versions[utility] = re.search('[0-9]+\\.[0-9.]*', self.print_and_run(command)[0]).group(0)
+            self.versions[utility] = re.search('[0-9]+\\.[0-9.]*', self.probe_version(command)[0]).group(0)
 
             
     @unless_only_basecall
@@ -1173,12 +2424,12 @@ class Analysis :
         for utility in ['minimap2'] :
             if self.validate_utility(utility, utility + ' is not on the PATH.') :
                 command = utility + ' --version'
-                self.versions[utility] = re.search('[0-9]+\\.[0-9.]*', self.print_and_run(command)[0]).group(0)
+                self.versions[utility] = re.search('[0-9]+\\.[0-9.]*', self.probe_version(command)[0]).group(0)
 
         for utility in ['Rscript', 'R'] :
             if self.validate_utility(utility, utility + ' is not on the PATH.') :
                 command = utility + ' --version 2>&1'
-                self.versions[utility] = re.search('[0-9]+\\.[0-9.]*', self.print_and_run(command)[0]).group(0)
+                self.versions[utility] = re.search('[0-9]+\\.[0-9.]*', self.probe_version(command)[0]).group(0)
             
         if not self.validate_file_and_size(self.plasmid_database) :
             self.errors += ['Can\'t find plasmid database ' + self.plasmid_database + ' or is size 0.  Try --download?']
@@ -1232,8 +2483,29 @@ class Analysis :
         self.analysis = ['download_databases']
         
         
+    def validate_parallel_steps(self) :
+
+        if self.max_parallel_steps < 1 :
+            self.errors += ['--max-parallel-steps must be at least 1, got ' + str(self.max_parallel_steps)]
+
+
+    def validate_cache_dir(self) :
+
+        if not self.cache_dir :
+            return
+
+        if os.path.exists(self.cache_dir) and not os.path.isdir(self.cache_dir) :
+            self.errors += ['Cache directory ' + self.cache_dir + ' is not a directory']
+            return
+
+        os.makedirs(self.cache_dir, exist_ok = True)
+
+
     def validate_options(self) :
 
+        self.validate_parallel_steps()
+        self.validate_cache_dir()
+
         self.validate_ont_watch()
         self.validate_ont_fast5()
         self.validate_ont_fastq()
@@ -1245,6 +2517,7 @@ class Analysis :
         self.validate_ont_fastq_info()
         
         self.validate_lorma()
+        self.validate_subsample_ont_fastq()
         
         self.validate_genome_fasta()
         
@@ -1265,6 +2538,7 @@ class Analysis :
         self.validate_assembly_info()
 
         self.validate_features()
+        self.validate_read_screen()
         self.validate_blast()
         self.validate_reference()
         self.validate_mutations()
@@ -1298,141 +2572,801 @@ class Analysis :
         
     def make_output_dir(self) :
 
-        if os.path.isdir(self.output_dir) :
-            shutil.rmtree(self.output_dir)
+        self.state_file = os.path.join(self.output_dir, '.state.pkl')
 
-        os.mkdir(self.output_dir)
+        if self.resume and os.path.isdir(self.output_dir) :
+            self.load_state()
+        else :
+            if os.path.isdir(self.output_dir) :
+                shutil.rmtree(self.output_dir)
+            os.mkdir(self.output_dir)
 
         # TODO - move this to it's own function?
         self.analysis_steps_txt = os.path.join(self.output_dir, 'analysis.txt')
         analysis_steps_handle = open(self.analysis_steps_txt, 'w')
-        analysis_steps_handle.write('\n'.join(self.analysis))
+        analysis_steps_handle.write('\n'.join([self.step_name(i) for i in self.analysis]))
         analysis_steps_handle.close()
+
+        self.start_logging()
+
+        # Write out anything traced before we had somewhere to put it
+        with trace_lock :
+            self.trace_file = os.path.join(self.output_dir, 'trace.jsonl')
+            with open(self.trace_file, 'a') as trace_handle :
+                for record in self.trace :
+                    trace_handle.write(json.dumps(record) + '\n')
         
         
+    def save_state(self) :
+
+        if self.state_file is None :
+            return
+
+        state = dict(self.__dict__)
+        for attribute in transient_attributes :
+            state.pop(attribute, None)
+
+        # Steps still running have only done part of their work, which would be done again on --resume,
+        # so save what they've changed as it was before they started
+        running_step_states = list(self.running_step_states.items())
+        if len(running_step_states) > 0 :
+            state['report'] = copy.deepcopy(self.report)
+        for step, before in running_step_states :
+            self.roll_back_step_state(state, step, before)
+
+        # Write to the side and then move so that a crash never leaves a half-written state
+        state_tmp = self.state_file + '.tmp'
+        joblib.dump(state, state_tmp)
+        os.replace(state_tmp, self.state_file)
+
+
+    def load_state(self) :
+
+        if not self.validate_file_and_size(self.state_file) :
+            self.print_warning('No saved state found in ' + self.output_dir + '; nothing to resume from')
+            return
+
+        self.print_and_log('Resuming analysis in ' + self.output_dir, self.main_process_verbosity, self.main_process_color)
+
+        # Only bring back what finished steps produced.  Options, and the plan built from them, come from this
+        # invocation, so a resumed run with, e.g., a different --racon-rounds uses the new value for what's left.
+        state = joblib.load(self.state_file)
+        restored = ['finished_steps', 'plan_rewrites', 'produced_attributes', 'report'] + sorted(state.get('produced_attributes', []))
+        for attribute in restored :
+            if attribute in transient_attributes or not attribute in state :
+                continue
+            setattr(self, attribute, state[attribute])
+
+
+    def step_is_finished(self, step) :
+
+        step = self.step_name(step)
+        if not step in self.finished_steps :
+            return False
+
+        step_dir = analysis_steps.get(step, {}).get('dir')
+        if step_dir is None :
+            return True
+
+        return self.has_valid_finish_file(os.path.join(self.output_dir, step_dir))
+
+
+    def clear_unfinished_step(self, step) :
+
+        # Remove anything a step left behind when it was interrupted, so that it can start clean
+        step_dir = analysis_steps.get(self.step_name(step), {}).get('dir')
+        if step_dir is None or analysis_steps[self.step_name(step)].get('resumable') :
+            return
+
+        step_dir = os.path.join(self.output_dir, step_dir)
+        if os.path.isdir(step_dir) :
+            self.print_and_log('Removing unfinished ' + step_dir, self.sub_process_verbosity, self.sub_process_color)
+            shutil.rmtree(step_dir)
+
+
+    def hash_value(self, key, value) :
+
+        # Files are hashed by content, not name, so the same reads/assembly anywhere give the same key
+        if isinstance(value, str) and os.path.isfile(value) :
+            key.update(file_fingerprint(value).encode())
+        elif isinstance(value, (list, tuple)) :
+            for i in value :
+                self.hash_value(key, i)
+        elif isinstance(value, dict) :
+            for name in sorted(value) :
+                key.update(repr(name).encode())
+                self.hash_value(key, value[name])
+        else :
+            key.update(repr(value).encode())
+
+
+    def hash_code(self, key, function, seen) :
+
+        # A function's code, the code nested in it (inner functions, lambdas, what a decorator wraps) and the
+        # code of the Analysis methods and module functions and classes it names, and so on down
+        if isinstance(function, type) :
+            if function.__module__ == __name__ and not function in seen :
+                seen.add(function)
+                for member in vars(function).values() :
+                    self.hash_code(key, member, seen)
+            return
+        function = getattr(function, '__func__', function)
+        if isinstance(function, types.FunctionType) :
+            for cell in function.__closure__ or [] :
+                try :
+                    self.hash_code(key, cell.cell_contents, seen)
+                except ValueError : # Empty cell
+                    pass
+            function = function.__code__
+        if not isinstance(function, types.CodeType) or function in seen :
+            return
+        seen.add(function)
+
+        key.update(function.co_code)
+        key.update(repr([i for i in function.co_consts if isinstance(i, (str, int, float))]).encode())
+        for const in function.co_consts :
+            if isinstance(const, types.CodeType) :
+                self.hash_code(key, const, seen)
+        for name in function.co_names :
+            self.hash_code(key, getattr(Analysis, name, None) or globals().get(name), seen)
+
+
+    def step_cache_key(self, step) :
+
+        step_info = analysis_steps[step]
+        key = hashlib.sha256(step.encode())
+
+        # The code of the step and everything it calls (including the strings its command lines are built
+        # from) stands in for its commands
+        key.update(str(cache_format_version).encode())
+        self.hash_code(key, getattr(Analysis, step), set())
+
+        for attribute in step_info.get('inputs', []) + step_info.get('params', []) :
+            key.update(attribute.encode())
+            self.hash_value(key, getattr(self, attribute, None))
+
+        for tool in step_info.get('tools', []) :
+            key.update((tool + str(self.versions.get(tool))).encode())
+
+        return key.hexdigest()
+
+
+    def report_cell(self, report_output) :
+
+        cell = self.report
+        for title_attribute in report_outputs[report_output][1:] :
+            cell = cell[getattr(self, title_attribute)]
+        return cell
+
+
+    def capture_step_state(self, step) :
+
+        # What the step's outputs look like before it runs, to work out what it changed
+        before = {'attributes' : dict(self.__dict__), 'lists' : {}, 'dicts' : {}, 'report' : {}, 'written' : set()}
+        for attribute, value in before['attributes'].items() :
+            if isinstance(value, list) :
+                before['lists'][attribute] = list(value)
+            elif isinstance(value, dict) and attribute != 'report' :
+                before['dicts'][attribute] = dict(value)
+        for output in analysis_steps.get(step, {}).get('outputs', []) :
+            if not output in report_outputs :
+                continue
+            try :
+                cell = self.report_cell(output)
+            except KeyError :
+                cell = None
+            if report_outputs[output][0] == 'append' and cell is not None :
+                before['report'][output] = len(cell)
+            else :
+                before['report'][output] = copy.deepcopy(cell)
+
+        step_context.written = before['written']
+        return before
+
+
+    def roll_back_step_state(self, state, step, before) :
+
+        # Put what a running step has changed in a saved state (with its own copy of the report) back how it was
+        changed = before['written'].copy() | set(analysis_steps.get(step, {}).get('outputs', []))
+        for attribute in changed - set(transient_attributes) - set(['report', 'finished_steps', 'plan_rewrites']) :
+            if attribute in before['lists'] :
+                state[attribute] = before['lists'][attribute]
+            elif attribute in before['dicts'] :
+                state[attribute] = before['dicts'][attribute]
+            elif attribute in before['attributes'] :
+                state[attribute] = before['attributes'][attribute]
+            else :
+                state.pop(attribute, None)
+
+        for output, value in before['report'].items() :
+            titles = [getattr(self, i) for i in report_outputs[output][1:]]
+            cells = state['report']
+            for title in titles[:-1] :
+                cells = cells.get(title, {})
+            if value is None :
+                cells.pop(titles[-1], None)
+            elif report_outputs[output][0] == 'append' :
+                cells[titles[-1]] = cells[titles[-1]].iloc[:value]
+            else :
+                cells[titles[-1]] = value
+
+
+    def store_cached_step(self, step, cache_key, before) :
+
+        written = before['written']
+        step_context.written = None
+
+        step_info = analysis_steps[step]
+        outputs = step_info.get('outputs', [])
+
+        # Attributes the step set or is declared to fill in; lists only keep what the step added
+        changes = {'output_dir' : self.output_dir, 'attributes' : {}, 'extended' : {}, 'report' : {}}
+        for attribute in (written | set(outputs)) - set(transient_attributes) :
+            if not attribute in self.__dict__ or attribute in ['report', 'finished_steps', 'plan_rewrites'] :
+                continue
+            value = self.__dict__[attribute]
+            if isinstance(value, list) and attribute in before['lists'] and \
+               value[:len(before['lists'][attribute])] == before['lists'][attribute] :
+                changes['extended'][attribute] = value[len(before['lists'][attribute]):]
+            else :
+                changes['attributes'][attribute] = value
+
+        for output in outputs :
+            if not output in report_outputs :
+                continue
+            cell = self.report_cell(output)
+            if report_outputs[output][0] == 'append' :
+                changes['report'][output] = cell.values.tolist()[before['report'][output] or 0:]
+            else :
+                changes['report'][output] = cell
+
+        # Build the entry off to the side then move it into place, so readers never see half of one
+        cache_entry = os.path.join(self.cache_dir, step, cache_key)
+        if os.path.isdir(cache_entry) :
+            return
+        self.print_and_log('Saving ' + step + ' results to the cache', self.sub_process_verbosity, self.sub_process_color)
+        cache_tmp = cache_entry + '.tmp.' + str(os.getpid()) + '.' + str(threading.get_ident())
+        shutil.copytree(os.path.join(self.output_dir, step_info['dir']), os.path.join(cache_tmp, 'files'),
+                        copy_function = shutil.copy2 if step_info.get('edits_outputs') else link_or_copy)
+        joblib.dump(changes, os.path.join(cache_tmp, 'changes.pkl'))
+        try :
+            os.rename(cache_tmp, cache_entry)
+        except OSError : # Somebody else got there first
+            shutil.rmtree(cache_tmp)
+
+
+    def restore_cached_step(self, step, cache_key) :
+
+        cache_entry = os.path.join(self.cache_dir, step, cache_key)
+        if not os.path.isdir(cache_entry) :
+            return False
+
+        self.print_and_log('Using cached results for ' + step, self.main_process_verbosity, self.main_process_color)
+
+        step_dir = os.path.join(self.output_dir, analysis_steps[step]['dir'])
+        shutil.copytree(os.path.join(cache_entry, 'files'), step_dir,
+                        copy_function = shutil.copy2 if analysis_steps[step].get('edits_outputs') else link_or_copy)
+
+        # Paths saved with the entry point into the output directory of the run that made it
+        changes = joblib.load(os.path.join(cache_entry, 'changes.pkl'))
+        old_output_dir = changes['output_dir']
+        for attribute, value in changes['attributes'].items() :
+            setattr(self, attribute, rebase_paths(value, old_output_dir, self.output_dir))
+        for attribute, value in changes['extended'].items() :
+            current = getattr(self, attribute)
+            setattr(self, attribute, current + [i for i in rebase_paths(value, old_output_dir, self.output_dir) if not i in current])
+
+        for output, value in changes['report'].items() :
+            value = rebase_paths(value, old_output_dir, self.output_dir)
+            if report_outputs[output][0] == 'append' :
+                cell = self.report_cell(output)
+                cell_titles = [getattr(self, i) for i in report_outputs[output][1:]]
+                if len(cell_titles) == 1 :
+                    self.report[cell_titles[0]] = cell.append(pandas.Series(value))
+                else :
+                    self.report[cell_titles[0]][cell_titles[1]] = cell.append(pandas.Series(value))
+            elif isinstance(value, pandas.Series) :
+                cell = self.report_cell(output)
+                for item_name, item in value.items() :
+                    cell[item_name] = item
+            else :
+                self.report[getattr(self, report_outputs[output][1])] = value
+
+        return True
+
+
     def start_logging(self):
         self.logging_file = os.path.join(self.output_dir, 'log.txt')
-        self.logging_handle = open(self.logging_file, 'w')
+        self.logging_handle = open(self.logging_file, 'a')
+
+
+    def critical_path(self, step_traces) :
+
+        # Walk back from the last step to finish, each time to the latest finishing step it had to wait for
+        path = []
+        current = max(step_traces, key = lambda i : i['end'])
+        while current :
+            path = [current] + path
+            waited_for = [i for i in step_traces if i['end'] <= current['start'] and self.steps_conflict(current['step'], i['step'])]
+            current = max(waited_for, key = lambda i : i['end']) if len(waited_for) > 0 else None
+        return path
+
+
+    def estimate_genome_bytes(self) :
+
+        # What an assembly will likely weigh: the reference if we have one, else --genome-size, else a typical bacterium
+        if self.reference_fasta and os.path.isfile(self.reference_fasta) :
+            return os.path.getsize(self.reference_fasta)
+        if self.genome_assembly_size :
+            size_match = re.match('^([0-9]+(\\.[0-9]+)?)([mkMK])$', self.genome_assembly_size)
+            if size_match :
+                return float(size_match.group(1)) * (10**6 if size_match.group(3) in 'mM' else 10**3)
+        return 5 * 10**6
+
+
+    def plan_analysis(self) :
+
+        # Walk the plan and estimate each step from its input size and the calibration from earlier runs
+        calibration = load_calibration(self.calibration)
+        sizes = {}
+        plan_rows = []
+        for step in self.analysis :
+            step_info = analysis_steps.get(self.step_name(step), {})
+            input_bytes = sum([sizes[i] if i in sizes else path_bytes(getattr(self, i, None))
+                               for i in step_info.get('inputs', [])])
+
+            estimate = {'step' : self.step_name(step), 'input_bytes' : input_bytes,
+                        'wall' : numpy.nan, 'disk_bytes' : numpy.nan, 'max_rss_kb' : numpy.nan}
+            if self.step_name(step) in calibration.index :
+                step_calibration = calibration.loc[self.step_name(step)]
+                for column, rate in [('wall', 'wall_rate'), ('disk_bytes', 'disk_rate'), ('max_rss_kb', 'rss_rate')] :
+                    if input_bytes > 0 and not numpy.isnan(step_calibration[rate]) :
+                        estimate[column] = step_calibration[rate] * input_bytes
+                    else :
+                        estimate[column] = step_calibration[column]
+            plan_rows += [estimate]
+
+            # Outputs we can guess the size of feed into later steps' inputs
+            if 'genome_fasta' in step_info.get('outputs', []) :
+                sizes['genome_fasta'] = self.estimate_genome_bytes()
+
+        plan = pandas.DataFrame(plan_rows)
+
+        # Play the plan through the scheduler's rules to see what overlaps
+        finish_times, running, pending, clock = {}, [], list(range(len(self.analysis))), 0
+        peak_rss_kb = 0
+        while len(pending) > 0 or len(running) > 0 :
+            for i in list(pending) :
+                if len(running) >= self.max_parallel_steps :
+                    break
+                earlier_steps = [self.analysis[j] for j in running] + [self.analysis[j] for j in pending if j < i]
+                if any([self.steps_conflict(self.analysis[i], earlier_step) for earlier_step in earlier_steps]) :
+                    continue
+                pending.remove(i)
+                running += [i]
+                finish_times[i] = clock + numpy.nan_to_num(plan.loc[i, 'wall'])
+            peak_rss_kb = max(peak_rss_kb, numpy.nansum(plan.loc[running, 'max_rss_kb']))
+            clock = min([finish_times[i] for i in running])
+            running = [i for i in running if finish_times[i] > clock]
+        plan['start'] = [finish_times[i] - numpy.nan_to_num(plan.loc[i, 'wall']) for i in range(len(plan))]
+
+        plan_table = pandas.DataFrame({'step' : plan['step'],
+                                       'input' : [format_kmg(i, decimals = 1) for i in plan['input_bytes']],
+                                       'start (s)' : plan['start'].round(0),
+                                       'wall (s)' : plan['wall'].round(0),
+                                       'disk' : ['-' if numpy.isnan(i) else format_kmg(i, decimals = 1) for i in plan['disk_bytes']],
+                                       'memory' : ['-' if numpy.isnan(i) else format_kmg(i * 1024, decimals = 1) for i in plan['max_rss_kb']]})
+        print(plan_table.to_string(index = False, na_rep = '-'))
+
+        totals = {'wall' : clock,
+                  'serial_wall' : numpy.nansum(plan['wall']),
+                  'disk_bytes' : numpy.nansum(plan['disk_bytes']),
+                  'max_rss_kb' : peak_rss_kb,
+                  'uncalibrated_steps' : list(plan.loc[plan['wall'].isna(), 'step'])}
+        print('\nEstimated run time {:.0f}s ({:.0f}s if run serially), disk {:s}, peak memory {:s}'.format(
+            totals['wall'], totals['serial_wall'], format_kmg(totals['disk_bytes'], decimals = 1),
+            format_kmg(totals['max_rss_kb'] * 1024, decimals = 1)))
+        if len(totals['uncalibrated_steps']) > 0 :
+            print('No calibration for ' + ', '.join(totals['uncalibrated_steps']) + '; add traces from runs that include them')
+        if self.multiplexed :
+            print('Per-barcode analyses aren\'t included; plan a barcode\'s own run to estimate those')
+
+        if self.plan_json :
+            plan_out = plan.replace({numpy.nan : None})
+            with open(self.plan_json, 'w') as plan_handle :
+                json.dump({'steps' : plan_out.to_dict(orient = 'records'), 'totals' : totals}, plan_handle, indent = 1)
+
+
+    def log_trace_summary(self) :
+
+        step_traces = [i for i in self.trace if i['type'] == 'step']
+        if len(step_traces) == 0 or not self.logging_handle :
+            return
+
+        # Roll the commands up into the step that ran them
+        summary = pandas.DataFrame(step_traces).set_index('step')
+        summary['cpu'] = summary['python_user'] + summary['python_sys']
+        summary['max_rss_kb'] = 0
+        summary['read_bytes'], summary['write_bytes'] = 0, 0
+        for command_trace in [i for i in self.trace if i['type'] == 'command' and i['step'] in summary.index] :
+            step = command_trace['step']
+            summary.loc[step, 'cpu'] += command_trace['user'] + command_trace['sys']
+            summary.loc[step, 'max_rss_kb'] = max(summary.loc[step, 'max_rss_kb'], command_trace['max_rss_kb'])
+            summary.loc[step, 'read_bytes'] += command_trace['read_bytes']
+            summary.loc[step, 'write_bytes'] += command_trace['write_bytes']
+
+        summary_table = pandas.DataFrame({'wall (s)' : summary['wall'].round(1),
+                                          'cpu (s)' : summary['cpu'].round(1),
+                                          'max RSS' : [format_kmg(i * 1024, decimals = 1) for i in summary['max_rss_kb']],
+                                          'read' : [format_kmg(i, decimals = 1) for i in summary['read_bytes']],
+                                          'written' : [format_kmg(i, decimals = 1) for i in summary['write_bytes']]})
+
+        path = self.critical_path(step_traces)
+        path_wall = sum([i['wall'] for i in path])
+        total_wall = max([i['end'] for i in step_traces]) - min([i['start'] for i in step_traces])
+
+        self.logging_handle.write('\nResource usage by step\n')
+        self.logging_handle.write(summary_table.to_string() + '\n')
+        self.logging_handle.write('\nCritical path ({:.1f}s of {:.1f}s total)\n'.format(path_wall, total_wall))
+        for step_trace in path :
+            self.logging_handle.write('{:s}\t{:.1f}s\n'.format(step_trace['step'], step_trace['wall']))
+        self.logging_handle.flush()
+
+        self.print_and_log('Critical path: ' + ' -> '.join([i['step'] for i in path]),
+                           self.sub_process_verbosity, self.sub_process_color)
         
 
     def watch_ont(self) :
 
         self.print_and_log('Watching ONT run in progress', self.main_process_verbosity, self.main_process_color)
 
-        # Keep track of FAST5 files that have been basecalled
-        seen_fast5 = pandas.Series()
         guppy_count = 0
 
-        # Where we will keep the guppy output of the FAST5 files
+        # Where we will keep the guppy output of the FAST5 files.  An interrupted watch leaves these behind (see
+        # 'resumable' in analysis_steps) so that it can pick up from its journal.
         self.ont_fastq_dir = os.path.join(self.output_dir, 'ont_fastq')
-        os.makedirs(self.ont_fastq_dir)
+        os.makedirs(self.ont_fastq_dir, exist_ok = True)
+        self.make_start_file(self.ont_fastq_dir)
         
         watch_dir = os.path.join(self.ont_fastq_dir, 'watch')
-        os.makedirs(watch_dir) 
+        os.makedirs(watch_dir, exist_ok = True)
+        watch_journal = os.path.join(watch_dir, 'journal.jsonl')
+        journal = read_watch_journal(watch_journal)
     
-        # Loop until either 1) We have enough reads or 2) It's been long enough between FAST5 dumps
-        start_time = time.time()
-        last_check_time = start_time
-
-        # Keep track of the new FASTQ files made so we can merge them later
+        # Loop until either 1) We have enough reads, 2) It's been long enough between FAST5 dumps or 3) We've run out of time
+        start_time = journal[0]['start_time'] if len(journal) > 0 else time.time()
+        last_fast5_time = time.time()
+        fast5_watcher = Fast5Watcher(self.ont_watch)
+        fast5_count = 0
+
+        # FAST5 files waiting to be basecalled, and when the oldest of them showed up
+        pending_fast5 = []
+        pending_time = None
+
+        # What has been basecalled so far
+        watch_read_count, watch_bases = 0, 0
+        watch_length_histogram = numpy.zeros(1, dtype = numpy.int64)
+        genome_bases = self.estimate_genome_bytes() if self.genome_assembly_size else None
+        enough_data = False
+
+        # Every FASTQ chunk basecalled so far; together they are the reads
         new_fastq = []
+
+        # Quick assemblies of what we have so far, one at a time, in the background
+        if self.ont_watch_provisional :
+            provisional_pool = mp.Pool(processes = 1)
+            provisional_result = None
+            provisional_time = time.time()
+            provisional_read_count = 0
+
+        # Pick up every batch that finished before we were interrupted, and throw away the one that didn't
+        if len(journal) > 0 :
+            self.print_and_log('Resuming watch from ' + str(len(journal)) + ' finished batches',
+                               self.sub_process_verbosity, self.sub_process_color)
+        for batch in journal :
+            fast5_watcher.seen.update(batch['fast5'])
+            fast5_count += len(batch['fast5'])
+            new_fastq += read_set_files(batch['fastq'])
+            guppy_count = batch['batch'] + 1
+        if len(journal) > 0 :
+            watch_read_count, watch_bases = journal[-1]['read_count'], journal[-1]['bases']
+            watch_length_histogram = fastq_stats(new_fastq, index_dir = self.read_index_dir())['length_histogram']
+            self.files_to_clean += [fastq_index_file(i, self.read_index_dir()) for i in new_fastq]
+        for batch_dir in glob.glob(os.path.join(watch_dir, '[0-9]*')) :
+            if int(os.path.basename(batch_dir)) >= guppy_count :
+                shutil.rmtree(batch_dir)
+        journal_handle = open(watch_journal, 'a')
+
+        # Screen each batch's reads for features as it comes in (barcodes screen their own), starting with the
+        # batches picked up from the journal, which is why this waits until they're in new_fastq.  Their hits
+        # are saved now in case no new batch comes in to save them.
+        watch_read_screen = None
+        if self.read_screen and len(self.feature_fastas) > 0 and not self.multiplexed :
+            watch_read_screen = ReadScreen()
+            if len(new_fastq) > 0 :
+                self.screen_reads(new_fastq, watch_read_screen)
+                self.read_screen_hits = self.save_read_screen(watch_read_screen, self.ont_fastq_dir)
+
+        method = 'ONT reads were basecalled using guppy (v ' + self.versions['guppy'] + ').'
+        self.report[self.methods_title][self.basecalling_methods] = \
+            self.report[self.methods_title][self.basecalling_methods].append(pandas.Series(method))
+
+        # With multiplexed runs, demultiplex each batch as it comes in and start each barcode's analysis as
+        # soon as that barcode has enough data, rather than waiting on the slowest barcode
+        demultiplex_batches = self.multiplexed and self.demux == 'qcat' and not self.only_basecall
+        if demultiplex_batches :
+            self.demultiplexed_dir = os.path.join(self.output_dir, 'demultiplex')
+            os.makedirs(self.demultiplexed_dir, exist_ok = True)
+            method = 'ONT reads were demultiplexed and trimmed using qcat (v ' + self.versions['qcat'] + ').'
+            self.report[self.methods_title][self.basecalling_methods] = \
+                self.report[self.methods_title][self.basecalling_methods].append(pandas.Series(method))
+            barcode_workers = max(1, min(self.max_parallel_steps, self.threads))
+            barcode_threads = max(1, self.threads // barcode_workers)
+            barcode_pool = mp.Pool(processes = barcode_workers)
+            barcode_counts = {}
+            barcode_results = {}
+
+            # Cut the barcode FASTQs back to where they were after the last finished batch, and restart any
+            # barcode analyses that had been started (they pick up from their own state with --resume)
+            if len(journal) > 0 :
+                for barcode, barcode_bytes in journal[-1]['barcode_bytes'].items() :
+                    barcode_fastq = os.path.join(self.demultiplexed_dir, barcode + '.fastq')
+                    os.truncate(barcode_fastq, barcode_bytes)
+                    barcode_stats = fastq_stats([barcode_fastq], index_dir = self.read_index_dir())
+                    self.files_to_clean += [fastq_index_file(barcode_fastq, self.read_index_dir())]
+                    barcode_counts[barcode] = {name : barcode_stats[name]
+                                               for name in ['read_count', 'bases', 'length_histogram']}
+                for barcode in journal[-1]['started_barcodes'] :
+                    self.print_and_log('Restarting analysis of ' + barcode, self.main_process_verbosity,
+                                       self.main_process_color)
+                    barcode_results[barcode] = barcode_pool.apply_async(
+                        run_barcode_analysis, ([self.opts, self.barcode_settings(barcode, barcode_threads)],))
         
         while (True) :
 
-            # See the whole set of FAST5 files
-            search_string = os.path.join(self.ont_watch, '*.fast5')
-            total_fast5 = pandas.Series(glob.glob(search_string))
-
-            # See how much time has elapsed since the last check
+            new_fast5 = fast5_watcher.wait_for_fast5(self.ont_watch_sleep_time)
             check_time = time.time()
-            since_last_check_time = check_time - last_check_time
-            total_time = check_time - start_time
-            last_check_time = check_time   
-
-            # See if the total time has passed the allotted time
-            if total_time >= self.ont_watch_time_max :
+            if len(new_fast5) > 0 :
+                if len(pending_fast5) == 0 :
+                    pending_time = check_time
+                pending_fast5 += new_fast5
+                fast5_count += len(new_fast5)
+                last_fast5_time = check_time
+
+            done = enough_data or \
+                check_time - last_fast5_time >= self.ont_watch_between_max or \
+                check_time - start_time >= self.ont_watch_time_max
+
+            # Basecall in batches big enough (or old enough) to be worth a guppy run
+            if len(pending_fast5) > 0 and (done or len(pending_fast5) >= self.ont_watch_batch_files or
+                                           check_time - pending_time >= self.ont_watch_batch_time) :
+                batch_dir = os.path.join(watch_dir, str(guppy_count))
+                batch_fastqs = self.basecall_fast5_batch(pending_fast5, batch_dir)
+                new_fastq += batch_fastqs
+                batch_fast5 = pending_fast5
+                pending_fast5 = []
+                guppy_count += 1
+
+                # Count what we actually got and see if it's enough
+                batch_stats = fastq_stats(batch_fastqs, index_dir = self.read_index_dir())
+                self.files_to_clean += [fastq_index_file(i, self.read_index_dir()) for i in batch_fastqs]
+                watch_read_count += batch_stats['read_count']
+                watch_bases += batch_stats['bases']
+                watch_length_histogram = add_histograms(watch_length_histogram, batch_stats['length_histogram'])
+                watch_n50 = histogram_n50(watch_length_histogram)
+                if demultiplex_batches :
+                    self.demultiplex_watch_batch(batch_fastqs, batch_dir, barcode_counts, barcode_results)
+                    for barcode in sorted(barcode_counts) :
+                        counts = barcode_counts[barcode]
+                        if barcode in barcode_results or \
+                           not self.watch_has_enough_data(counts['read_count'], counts['bases'],
+                                                          histogram_n50(counts['length_histogram']), genome_bases,
+                                                          barcode) :
+                            continue
+                        self.print_and_log('Starting analysis of ' + barcode, self.main_process_verbosity,
+                                           self.main_process_color)
+                        barcode_results[barcode] = barcode_pool.apply_async(
+                            run_barcode_analysis, ([self.opts, self.barcode_settings(barcode, barcode_threads)],))
+
+                    # Done once every barcode that's a real part of the run has been started
+                    enough_data = len(barcode_results) > 0 and \
+                        all([barcode in barcode_results for barcode in barcode_counts
+                             if 100 * barcode_counts[barcode]['read_count'] / watch_read_count >= self.barcode_min_fraction])
+                else :
+                    enough_data = self.watch_has_enough_data(watch_read_count, watch_bases, watch_n50, genome_bases)
+
+                if watch_read_screen is not None :
+                    self.screen_reads(batch_fastqs, watch_read_screen)
+                    self.read_screen_hits = self.save_read_screen(watch_read_screen, self.ont_fastq_dir)
+
+                # Only now is the batch done, so journal it.  Totals are running totals so the last line has them all.
+                batch_record = {'batch' : guppy_count - 1,
+                                'start_time' : start_time,
+                                'fast5' : batch_fast5,
+                                'fastq' : batch_fastqs,
+                                'read_count' : watch_read_count,
+                                'bases' : watch_bases}
+                if demultiplex_batches :
+                    batch_record['barcode_bytes'] = {barcode : os.path.getsize(os.path.join(self.demultiplexed_dir, barcode + '.fastq'))
+                                                     for barcode in barcode_counts}
+                    batch_record['started_barcodes'] = sorted(barcode_results)
+                journal_handle.write(json.dumps(batch_record) + '\n')
+                journal_handle.flush()
+                os.fsync(journal_handle.fileno())
+
+                if enough_data :
+                    done = True
+
+            # Start a new provisional analysis once the last one is done, if it's time and there are new reads
+            if self.ont_watch_provisional and not done :
+                if provisional_result is not None and provisional_result.ready() :
+                    # A provisional analysis going wrong shouldn't take the watch down with it
+                    provisional_finished = provisional_result.successful() and provisional_result.get()
+                    self.print_and_log('Provisional analysis of ' + str(provisional_read_count) + ' reads ' +
+                                       ('finished in ' if provisional_finished else 'failed in ') +
+                                       os.path.join(self.output_dir, 'provisional'),
+                                       self.main_process_verbosity, self.main_process_color)
+                    provisional_result = None
+                if provisional_result is None and watch_read_count > provisional_read_count and \
+                   check_time - provisional_time >= self.ont_watch_provisional :
+                    provisional_result = self.start_provisional_analysis(provisional_pool, list(new_fastq))
+                    provisional_time = check_time
+                    provisional_read_count = watch_read_count
+
+            if done :
                 break
+        fast5_watcher.close()
+        journal_handle.close()
 
-            # Get the set of new FAST5 files currently in the output directory
-            new_fast5 = total_fast5[~total_fast5.isin(seen_fast5)]
-            seen_fast5 = total_fast5
+        # A provisional analysis still running is out of date now that the full analysis is starting
+        if self.ont_watch_provisional :
+            provisional_pool.terminate()
 
-            # See if there are any new FAST5 files
-            if len(new_fast5) == 0 :
-                if since_last_check_time >= self.ont_watch_between_max :
-                    break
-                else :
-                    continue
+        # Make sure that we actually called some bases
+        if fast5_count == 0 :
+            self.print_and_log('No reads were basecalled through --ont-watch.', 0, Colors.FAIL)
+            self.error_out()
 
-            # If we do have new FAST5 files, make a directory to basecall them
-            fast5_dir = os.path.join(watch_dir, str(guppy_count))
-            os.makedirs(fast5_dir)
-            guppy_dir = os.path.join(fast5_dir, 'guppy')
-            os.makedirs(guppy_dir)
-    
-            # Link all of the FAST5 files into the new directory
-            for fast5 in new_fast5 :
+        # The batches' chunks are the reads; anything that needs them in one file merges them itself
+        self.ont_raw_fastq = new_fastq if len(new_fastq) > 1 else new_fastq[0]
+        self.ont_fastq = self.ont_raw_fastq
 
-                # Make a link for each FAST5 in the guppy directory
-                command = ' '.join(['ln -rs',
-                            fast5, fast5_dir])
-                self.print_and_run(command)
-                
-            # Basecall the new FAST5 files with guppy
-            guppy_stdout, guppy_stderr = self.std_files(os.path.join(self.ont_fastq_dir, 'guppy'))
-            command = ' '.join(['guppy_basecaller',
-                        '-i', fast5_dir,
-                        '-s', guppy_dir,
-                        '--compress-fastq',
-                        '--device "cuda:0"',
-                        '--flowcell FLO-MIN106 --kit SQK-RBK004',
-                        '1>' + guppy_stdout, '2>' + guppy_stderr])
-            self.print_and_run(command)
-                
-            # Keep track of all of the different FASTQ files produced
-            search_string = os.path.join(guppy_dir, '*.fastq')
-            merged_fastq = os.path.join(guppy_dir, 'ont_raw.fastq')
-            command = ' '.join(['cat', search_string, '>', merged_fastq])
-            self.print_and_run(command)
+        if demultiplex_batches :
+            self.finish_watch_barcodes(barcode_pool, barcode_threads, barcode_counts, barcode_results, watch_read_count)
+
+        self.make_finish_file(self.ont_fastq_dir)
+        
+        
+    def watch_has_enough_data(self, read_count, bases, n50, genome_bases, barcode = None) :
 
-            # Make sure the merged FASTQ file exists and has size > 0
-            self.validate_file_and_size_or_error(merged_fastq, 'ONT raw FASTQ file', 'cannot be found after guppy', 'is empty.')    
-            new_fastq += [merged_fastq]
+        # Stop on whichever comes first: enough reads, enough depth, or a good enough N50 (but only once there's
+        # the minimum depth to assemble with)
+        depth = bases / genome_bases if genome_bases else None
+        status = 'Basecalled ' + str(read_count) + ' reads, ' + format_kmg(bases, decimals = 1) + 'b, N50 ' + str(n50)
+        if barcode :
+            status = barcode + ': ' + status
+        if depth is not None :
+            status += ', {:.1f}X'.format(depth)
+        self.print_and_log(status, self.sub_process_verbosity, self.sub_process_color)
 
-            # Keep track of files to clean up
-            search_string = os.path.join(guppy_dir, 'fastq*.fastq')
-            individual_fastq = glob.glob(search_string)
-            self.files_to_clean += individual_fastq
+        if read_count >= self.ont_watch_reads_min :
+            return True
+        if self.ont_watch_depth and depth >= self.ont_watch_depth :
+            return True
+        if self.ont_watch_n50 and n50 >= self.ont_watch_n50 and depth >= self.ont_coverage_min :
+            return True
+        return False
 
-            # If we've passed the minimum number of reads then we stop here
-            total_reads = len(seen_fast5) * 1000
-            if total_reads >= self.ont_watch_reads_min :
-                break
 
-            guppy_count += 1
-            time.sleep(self.ont_watch_sleep_time)
+    def start_provisional_analysis(self, provisional_pool, new_fastq) :
 
-        # Make sure that we actually called some bases
-        if len(seen_fast5) == 0 :
-            self.print_and_log('No reads were basecalled through --ont-watch.', 0, Colors.FAIL)
+        # Assemble the chunks basecalled so far quickly with miniasm, give the draft one round of racon (miniasm
+        # doesn't correct the reads, so its raw draft is too error-prone to find features in), then look for
+        # features and report on that draft.  Each one replaces the last in <output>/provisional.
+        self.print_and_log('Starting provisional analysis of the reads so far', self.main_process_verbosity, self.main_process_color)
+        settings = self.barcode_settings('provisional', max(1, self.threads // 2), new_fastq)
+        settings.update({'resume' : False,
+                         'assembler' : 'miniasm',
+                         'racon_rounds' : 1,
+                         'racon_keep_paf' : False})
+        provisional_analysis = ['make_output_dir', 'ont_fastq_info', 'miniasm_ont_fastq', 'racon_ont_assembly'] + \
+            [step for step in ['blast_feature_sets', 'make_report'] if step in self.analysis]
+
+        return provisional_pool.apply_async(run_barcode_analysis, ([self.opts, settings, provisional_analysis],))
+
+
+    def demultiplex_watch_batch(self, batch_fastqs, batch_dir, barcode_counts, barcode_results) :
+
+        # qcat the batch, then add each barcode's reads to its FASTQ and counts, unless its analysis has already started
+        batch_demultiplexed_dir = os.path.join(batch_dir, 'demultiplex')
+        os.makedirs(batch_demultiplexed_dir)
+        batch_fastq = self.merged_fastq(batch_fastqs)
+        self.run_qcat(batch_fastq, batch_demultiplexed_dir)
+        if not batch_fastq in batch_fastqs :
+            os.remove(batch_fastq)
+
+        for batch_barcode_fastq in sorted(glob.glob(os.path.join(batch_demultiplexed_dir, 'barcode*.fastq'))) :
+            barcode = os.path.basename(batch_barcode_fastq)[:-len('.fastq')]
+            if barcode in barcode_results :
+                continue
+
+            # Start the barcode's FASTQ fresh the first time we see it, in case this is a rerun
+            barcode_fastq = os.path.join(self.demultiplexed_dir, barcode + '.fastq')
+            with open(batch_barcode_fastq, 'rb') as batch_handle, \
+                 open(barcode_fastq, 'ab' if barcode in barcode_counts else 'wb') as barcode_handle :
+                shutil.copyfileobj(batch_handle, barcode_handle)
+
+            batch_stats = fastq_stats([batch_barcode_fastq], index_dir = self.read_index_dir())
+            self.files_to_clean += [fastq_index_file(batch_barcode_fastq, self.read_index_dir())]
+            counts = barcode_counts.setdefault(barcode, {'read_count' : 0, 'bases' : 0,
+                                                         'length_histogram' : numpy.zeros(1, dtype = numpy.int64)})
+            counts['read_count'] += batch_stats['read_count']
+            counts['bases'] += batch_stats['bases']
+            counts['length_histogram'] = add_histograms(counts['length_histogram'], batch_stats['length_histogram'])
+
+
+    def finish_watch_barcodes(self, barcode_pool, barcode_threads, barcode_counts, barcode_results, read_count) :
+
+        # Whatever didn't reach its target still gets analyzed, as long as it's a real part of the run
+        for barcode in sorted(barcode_counts) :
+            if barcode in barcode_results :
+                continue
+            if 100 * barcode_counts[barcode]['read_count'] / read_count < self.barcode_min_fraction :
+                continue
+            self.print_and_log('Starting analysis of ' + barcode, self.main_process_verbosity, self.main_process_color)
+            barcode_results[barcode] = barcode_pool.apply_async(
+                run_barcode_analysis, ([self.opts, self.barcode_settings(barcode, barcode_threads)],))
+        barcode_pool.close()
+        barcode_pool.join()
+
+        if len(barcode_results) == 0 :
+            self.print_and_log('No barcodes had enough reads to analyze.', 0, Colors.FAIL)
+            self.error_out()
+
+        self.barcodes = sorted(barcode_results)
+        failed_barcodes = [barcode for barcode in self.barcodes if not barcode_results[barcode].get()]
+        if len(failed_barcodes) > 0 :
+            self.print_and_log('Analysis of ' + ', '.join(failed_barcodes) + ' failed; exiting', 0, Colors.FAIL)
             self.error_out()
 
-        # Merge the smaller FASTQ files
-        self.ont_raw_fastq = os.path.join(self.ont_fastq_dir, 'ont_raw.fastq')
-        command = ' '.join(['cat',
-                    ' '.join(new_fastq),
-                    '>', self.ont_raw_fastq])
+        # The barcodes have been demultiplexed and analyzed, so there's nothing left to do here
+        self.analysis = ['clean_up']
+
+
+    def basecall_fast5_batch(self, fast5_files, fast5_dir) :
+
+        self.print_and_log('Basecalling ' + str(len(fast5_files)) + ' new FAST5 files', self.sub_process_verbosity, self.sub_process_color)
+
+        os.makedirs(fast5_dir)
+        guppy_dir = os.path.join(fast5_dir, 'guppy')
+        os.makedirs(guppy_dir)
+
+        # Link all of the FAST5 files into the new directory (relative, like ln -rs)
+        for fast5 in fast5_files :
+            os.symlink(os.path.relpath(fast5, fast5_dir), os.path.join(fast5_dir, os.path.basename(fast5)))
+
+        # Basecall the new FAST5 files with guppy
+        guppy_stdout, guppy_stderr = self.std_files(os.path.join(self.ont_fastq_dir, 'guppy'))
+        command = ' '.join(['guppy_basecaller',
+                    '-i', fast5_dir,
+                    '-s', guppy_dir,
+                    '--compress-fastq',
+                    '--device "cuda:0"',
+                    '--flowcell FLO-MIN106 --kit SQK-RBK004',
+                    '1>' + guppy_stdout, '2>' + guppy_stderr])
         self.print_and_run(command)
-        self.files_to_clean += new_fastq
 
-        self.validate_file_and_size_or_error(self.ont_raw_fastq, 'ONT raw FASTQ file', 'cannot be found after merging', 'is empty.')
-        self.ont_fastq = self.ont_raw_fastq
+        # The batch's reads are the FASTQ chunks guppy wrote
+        batch_fastqs = read_set_files(expand_read_set(guppy_dir))
+        if len(batch_fastqs) == 0 :
+            self.print_and_log('No FASTQ files found after guppy in ' + guppy_dir + '; exiting', 0, Colors.FAIL)
+            self.error_out()
+        for fastq in batch_fastqs :
+            self.validate_file_and_size_or_error(fastq, 'ONT raw FASTQ file', 'cannot be found after guppy', 'is empty.')
+
+        return batch_fastqs
+
 
-        method = 'ONT reads were basecalled using guppy (v ' + self.versions['guppy'] + ').'
-        self.report[self.methods_title][self.basecalling_methods] = \
-            self.report[self.methods_title][self.basecalling_methods].append(pandas.Series(method))
-        
-        
     def guppy_ont_fast5(self) :
         
         self.print_and_log('Basecalling ONT reads with Guppy', self.main_process_verbosity, self.main_process_color)        
@@ -1459,14 +3393,13 @@ class Analysis :
                     '1>' + guppy_stdout, '2>' + guppy_stderr])
         self.print_and_run(command)
 
-        # Merge the smaller FASTQ files
-        self.print_and_log('Merging Guppy runs into raw ONT FASTQ', self.sub_process_verbosity, self.sub_process_color)
-        self.ont_raw_fastq = os.path.join(self.ont_fastq_dir, 'ont_raw.fastq')
-        command = ' '.join(['cat', self.ont_fastq_dir + '/*.fastq >', self.ont_raw_fastq])
-        self.print_and_run(command)
-
-        # Make sure the merged FASTQ file exists and has size > 0
-        self.validate_file_and_size_or_error(self.ont_raw_fastq, 'ONT raw FASTQ file', 'cannot be found after albacore', 'is empty')
+        # Guppy's FASTQ chunks are the reads; anything that needs them in one file merges them itself
+        self.ont_raw_fastq = expand_read_set(self.ont_fastq_dir)
+        if len(self.ont_raw_fastq) == 0 :
+            self.print_and_log('No FASTQ files found after guppy; exiting', 0, Colors.FAIL)
+            self.error_out()
+        for fastq in read_set_files(self.ont_raw_fastq) :
+            self.validate_file_and_size_or_error(fastq, 'ONT raw FASTQ file', 'cannot be found after guppy', 'is empty')
 
         self.ont_fastq = self.ont_raw_fastq
 
@@ -1493,30 +3426,26 @@ class Analysis :
             qcat_input_fastq = self.ont_fastq
             
         self.print_and_log('Running qcat on raw ONT FASTQ', self.sub_process_verbosity, self.sub_process_color)
-        qcat_stdout, qcat_stderr = self.std_files(os.path.join(self.demultiplexed_dir, 'qcat'))
-        command = ' '.join(['qcat',
-                            '--trim',
-                            '--guppy',
-                            '--min-score 65',
-                            '--kit RBK004',
-                            '-t', str(self.threads),
-                            '-f', qcat_input_fastq,
-                            '-b', self.demultiplexed_dir,
-                            '1>' + qcat_stdout, '2>' + qcat_stderr])
-        self.print_and_run(command)
+        self.run_qcat(self.merged_fastq(qcat_input_fastq), self.demultiplexed_dir)
 
         # Figure out if we need to run multiple analyses, i.e, we have multiple barcodes
+        self.barcode_stats = self.demultiplexed_stats(self.demultiplexed_dir)
         barcode_summary_tsv = os.path.join(self.demultiplexed_dir, 'barcode_summary.tsv')
-        command = ' '.join(['cat',
-                           qcat_stderr,
-                           '| grep -E \'barcode[0-9]+\'',
-                            '|awk \'{OFS="\\t"; print $1,$2,$(NF - 1)}\'',
-                           '>' + barcode_summary_tsv])
-        self.print_and_run(command)
+        self.barcode_stats.loc[:, ['barcode', 'read_count', 'fraction']].to_csv(barcode_summary_tsv, sep = '\t',
+                                                                               header = False, index = False,
+                                                                               float_format = '%.2f')
         self.validate_file_and_size_or_error(barcode_summary_tsv, 'Barcode summary', 'cannot be found after qcat', 'is empty')
 
-        self.barcode_summary = pandas.read_csv(filepath_or_buffer = barcode_summary_tsv, sep = '\t', header = None)
-        self.barcode_summary = self.barcode_summary.loc[self.barcode_summary.iloc[:, 2] >= self.barcode_min_fraction, :] 
+        # Drop barcodes without enough of the reads to be worth an analysis before anything is scheduled for them
+        self.barcode_summary = self.barcode_stats.loc[self.barcode_stats['fraction'] >= self.barcode_min_fraction,
+                                                      ['barcode', 'read_count', 'fraction']]
+        for barcode, read_count in zip(self.barcode_stats['barcode'], self.barcode_stats['read_count']) :
+            if not barcode in self.barcode_summary['barcode'].values :
+                self.print_and_log('Skipping ' + barcode + ' with only ' + str(read_count) + ' reads',
+                                   self.sub_process_verbosity, self.sub_process_color)
+        if len(self.barcode_summary) == 0 :
+            self.print_and_log('No barcode has at least ' + str(self.barcode_min_fraction) + '% of the reads.', 0, Colors.FAIL)
+            self.error_out()
         self.barcodes = self.barcode_summary.iloc[:, 0].values
         
         method = 'ONT reads were demultiplexed and trimmed using qcat (v ' + self.versions['qcat'] + ').'
@@ -1531,37 +3460,214 @@ class Analysis :
 
         self.make_finish_file(self.demultiplexed_dir)
 
+
+    def demultiplexed_stats(self, demultiplexed_dir) :
+
+        # Read stats for every barcode's FASTQ, from the indexes that the barcode analyses will then reuse
+        barcode_fastqs = sorted(glob.glob(os.path.join(demultiplexed_dir, '*.fastq')))
+        with concurrent.futures.ThreadPoolExecutor(max_workers = int(self.step_threads())) as executor :
+            all_stats = list(executor.map(lambda fastq : fastq_stats([fastq], index_dir = self.read_index_dir()), barcode_fastqs))
+        self.files_to_clean += [fastq_index_file(i, self.read_index_dir()) for i in barcode_fastqs]
+
+        # Reads qcat couldn't assign ('none') count toward the fractions but aren't a barcode
+        total_reads = max(1, sum([i['read_count'] for i in all_stats]))
+        rows, histogram_rows = [], []
+        for barcode_fastq, stats in zip(barcode_fastqs, all_stats) :
+            barcode = os.path.basename(barcode_fastq)[:-len('.fastq')]
+            if barcode == 'none' :
+                continue
+            rows += [[barcode, stats['read_count'], stats['bases'], 100 * stats['read_count'] / total_reads,
+                      stats['n50'], stats['mean_length'], stats['mean_quality']]]
+
+            # Lengths in kb bins, to keep the table a sensible size
+            length_kb_histogram = numpy.bincount(numpy.arange(len(stats['length_histogram'])) // 1000,
+                                                 weights = stats['length_histogram']).astype(numpy.int64)
+            for histogram, counts in [['length_kb', length_kb_histogram], ['base_quality', stats['quality_histogram']]] :
+                for i in numpy.flatnonzero(counts) :
+                    histogram_rows += [[barcode, histogram, int(i), int(counts[i])]]
+
+        barcode_stats = pandas.DataFrame(rows, columns = ['barcode', 'read_count', 'bases', 'fraction', 'n50',
+                                                          'mean_length', 'mean_quality'])
+        barcode_stats = barcode_stats.sort_values('read_count', ascending = False).reset_index(drop = True)
+        barcode_stats.to_csv(os.path.join(demultiplexed_dir, 'barcode_stats.tsv'), sep = '\t', index = False,
+                             float_format = '%.2f')
+        pandas.DataFrame(histogram_rows, columns = ['barcode', 'histogram', 'bin', 'count']).to_csv(
+            os.path.join(demultiplexed_dir, 'barcode_histograms.tsv'), sep = '\t', index = False)
+
+        return barcode_stats
+
+
+    def run_qcat(self, input_fastq, output_dir) :
+
+        # Demultiplex and trim into <output_dir>/<barcode>.fastq, returning qcat's stderr, which has the barcode summary
+        qcat_stdout, qcat_stderr = self.std_files(os.path.join(output_dir, 'qcat'))
+        command = ' '.join(['qcat',
+                            '--trim',
+                            '--guppy',
+                            '--min-score 65',
+                            '--kit RBK004',
+                            '-t', self.step_threads(),
+                            '-f', input_fastq,
+                            '-b', output_dir,
+                            '1>' + qcat_stdout, '2>' + qcat_stderr])
+        self.print_and_run(command)
+
+        return qcat_stderr
+
+        
+    def barcode_settings(self, barcode, threads, ont_fastq = None) :
+
+        # Workers build their analysis from the options, so they only need to be told what's different about a
+        # barcode, and the few things we worked out that they don't
+        ont_fastq = ont_fastq or os.path.join(self.demultiplexed_dir, barcode + '.fastq')
+        settings = {name : getattr(self, name) for name in barcode_shared_attributes}
+        settings.update({'multiplexed' : False,
+                         'is_barcode' : True,
+                         'threads' : threads,
+                         'output_dir' : os.path.join(self.output_dir, barcode),
+                         'ont_fastq' : ont_fastq,
+                         'ont_raw_fastq' : ont_fastq})
+        return settings
+
         
     def start_barcode_analysis(self) :
 
         self.print_and_log('Starting analysis of individual barcodes.', self.main_process_verbosity, self.main_process_color)
         
-        for barcode in self.barcodes :
-            barcode_analysis = copy.deepcopy(self)
-            barcode_analysis.analysis = []
-            barcode_analysis.multiplexed = False
-            barcode_analysis.output_dir = os.path.join(self.output_dir, barcode)
-            barcode_analysis.ont_fastq = os.path.join(self.demultiplexed_dir, barcode + '.fastq')
-            barcode_analysis.is_barcode = True
-            barcode_analysis.files_to_clean = []
-            barcode_analysis.validate_options()
-            barcode_analysis.feature_fastas = self.feature_fastas
-            if len(barcode_analysis.analysis) > 0 :
-                barcode_analysis.go()
+        # Run several barcodes at once, splitting the threads between them
+        barcode_workers = max(1, min(len(self.barcodes), self.max_parallel_steps, self.threads))
+        barcode_threads = max(1, self.threads // barcode_workers)
+
+        barcode_settings = [self.barcode_settings(barcode, barcode_threads) for barcode in self.barcodes]
+
+        pool = mp.Pool(processes = barcode_workers)
+        results = pool.map(run_barcode_analysis, [[self.opts, i] for i in barcode_settings])
+        pool.close()
+        pool.join()
+
+        failed_barcodes = [barcode for barcode, result in zip(self.barcodes, results) if not result]
+        if len(failed_barcodes) > 0 :
+            self.print_and_log('Analysis of ' + ', '.join(failed_barcodes) + ' failed; exiting', 0, Colors.FAIL)
+            self.error_out()
+
+
+    def subsample_ont_fastq(self) :
+
+        self.print_and_log('Subsampling ONT reads to the target depths', self.main_process_verbosity, self.main_process_color)
+
+        self.subsample_dir = os.path.join(self.output_dir, 'subsample')
+        os.makedirs(self.subsample_dir)
+        self.make_start_file(self.subsample_dir)
+
+        # Rank reads by length weighted by accuracy, so each depth's subset is the best reads, and smaller
+        # depths are subsets of larger ones
+        indexes = [fastq_index(fastq, int(self.step_threads()), self.read_index_dir()) for fastq in read_set_files(self.ont_fastq)]
+        index = {name : numpy.concatenate([i[name] for i in indexes]) for name in ['lengths', 'mean_qualities']}
+        scores = index['lengths'] * (1 - 10 ** (-index['mean_qualities'] / 10))
+        order = numpy.argsort(-scores, kind = 'stable')
+        ranks = numpy.empty(len(order), dtype = numpy.int64)
+        ranks[order] = numpy.arange(len(order))
+        cumulative_bases = numpy.cumsum(index['lengths'][order])
+        genome_bytes = self.estimate_genome_bytes()
+
+        subset_handles = {}
+        read_counts = {}
+        for depth in sorted(set([i for i in self.ont_depths.values() if i is not None])) :
+            read_count = int(numpy.searchsorted(cumulative_bases, depth * genome_bytes)) + 1
+            if read_count >= len(order) :
+                self.print_and_log('Not enough reads for {:.0f}X; using them all'.format(depth), self.sub_process_verbosity, self.sub_process_color)
+                continue
+            subset_fastq = os.path.join(self.subsample_dir, 'ont_{:g}x.fastq'.format(depth))
+            subset_handles[subset_fastq] = open(subset_fastq, 'wb')
+            read_counts[subset_fastq] = read_count
+            self.ont_fastq_subset_scales[subset_fastq] = float(cumulative_bases[-1] / cumulative_bases[read_count - 1])
+            self.files_to_clean += [subset_fastq]
+            for step, step_depth in self.ont_depths.items() :
+                if step_depth == depth :
+                    self.ont_fastq_subsets[step] = subset_fastq
+
+        # One pass over the reads writes every subset
+        if len(subset_handles) > 0 :
+            for read_i, (offset, header, sequence, quality) in enumerate(read_set_records(self.ont_fastq, int(self.step_threads()))) :
+                for subset_fastq, subset_handle in subset_handles.items() :
+                    if ranks[read_i] < read_counts[subset_fastq] :
+                        subset_handle.write(header + b'\n' + sequence + b'\n+\n' + quality + b'\n')
+        for subset_fastq, subset_handle in subset_handles.items() :
+            subset_handle.close()
+            self.validate_file_and_size_or_error(subset_fastq, 'ONT subset FASTQ', 'cannot be found after subsampling', 'is empty')
+            self.print_and_log('Wrote ' + str(read_counts[subset_fastq]) + ' reads to ' + subset_fastq,
+                               self.sub_process_verbosity, self.sub_process_color)
+
+        self.make_finish_file(self.subsample_dir)
+
+
+    def estimate_genome_size(self) :
+
+        self.print_and_log('Estimating genome size from ONT read k-mers', self.main_process_verbosity, self.main_process_color)
+        genome_size, depth = kmer_genome_size(self.ont_fastq_stream('estimate_genome_size'), int(self.step_threads()))
+        if genome_size == 0 :
+            self.print_and_log('Could not estimate the genome size from ' + read_set_arg(self.ont_fastq) + '; use --genome-size', 0, Colors.FAIL)
+            self.error_out()
+
+        self.genome_assembly_size = '{:.2f}m'.format(genome_size / 10**6)
+        self.ont_depth_estimate = depth
+        self.print_and_log('Estimated genome size ' + self.genome_assembly_size + ' at {:.0f}X ONT depth'.format(depth),
+                           self.sub_process_verbosity, self.sub_process_color)
+
+        method = 'Genome size ({:.2f} Mb) and ONT depth ({:.0f}X) were estimated from a 1/200 FracMinHash sample of canonical 17-mers in the ONT reads.'.format(genome_size / 10**6, depth)
+        self.report[self.methods_title][self.assembly_methods] = \
+            self.report[self.methods_title][self.assembly_methods].append(pandas.Series(method))
+
+
+    def ont_fastq_for(self, step) :
+
+        # The reads a step should map: its depth-targeted subset if it has one, otherwise all of them
+        return self.ont_fastq_subsets.get(step, self.ont_fastq)
+
+
+    def ont_fastq_stream(self, step) :
+
+        # ont_fastq_for(step), for a single pass: the step's pipe if the scheduler started it alongside other
+        # steps reading the same reads (see start_read_fanouts())
+        fanout = self.read_fanouts.get(step)
+        return (fanout and fanout.pipe(step)) or self.ont_fastq_for(step)
+
+
+    def start_read_fanouts(self, steps) :
+
+        # Steps starting together that read the same reads in one pass share one read of them
+        if not self.stream_reads :
+            return
+        read_set_steps = {}
+        for step in [self.step_name(i) for i in steps] :
+            step_info = analysis_steps.get(step, {})
+            if step_info.get('streams') and not any([getattr(self, i, None) for i in step_info.get('streams_unless', [])]) :
+                read_set_steps.setdefault(tuple(read_set_files(self.ont_fastq_for(step))), []).append(step)
+        for read_set, read_set_steps in read_set_steps.items() :
+            if len(read_set_steps) < 2 :
+                continue
+            self.print_and_log('Streaming the ONT reads once to ' + ', '.join(read_set_steps),
+                               self.sub_process_verbosity, self.sub_process_color)
+            fanout = ReadFanout(list(read_set), read_set_steps, os.path.join(self.output_dir, 'read_streams'),
+                                max(1, self.threads // self.max_parallel_steps))
+            for step in read_set_steps :
+                self.read_fanouts[step] = fanout
+
+
+    def read_index_dir(self) :
+
+        # Where FASTQ indexes (see fastq_index()) are kept, so they're reused by later steps and --resume
+        return os.path.join(self.output_dir, 'read_index')
 
 
     def ont_fastq_info(self) :
 
-        opener = 'cat'
-        if (re.search('\.(gz|gzip)$', self.ont_fastq)) :
-            opener = 'gunzip -c'
-        command = ' '.join([opener,
-                            self.ont_fastq,
-                            '| awk \'{getline;print length($0);s += length($1);getline;getline;}END{print "+"s}\'',
-                            '| sort -gr',
-                            '| awk \'BEGIN{bp = 0;f = 0}{if(NR == 1){sub("+", "", $1);s=$1}else{bp += $1;if(bp > s / 2 && f == 0){n50 = $1;f = 1}}}END{print n50"\t"NR"\t"s;exit}\''])
-        self.ont_n50, self.ont_read_count, self.ont_bases = [int(i) for i in re.split('\\t', self.print_and_run(command)[0])]
-        self.ont_bases = format_kmg(self.ont_bases, decimals = 1)
+        self.print_and_log('Getting ONT read statistics', self.sub_process_verbosity, self.sub_process_color)
+        self.ont_fastq_stats = fastq_stats(read_set_files(self.ont_fastq), threads = int(self.step_threads()),
+                                           index_dir = self.read_index_dir())
+        self.ont_n50 = self.ont_fastq_stats['n50']
+        self.ont_read_count = self.ont_fastq_stats['read_count']
+        self.ont_bases = format_kmg(self.ont_fastq_stats['bases'], decimals = 1)
 
         if self.ont_n50 <= self.ont_n50_min :
             warning = 'ONT N50 (' + str(self.ont_n50) + ') is less than the recommended minimum (' + str(self.ont_n50_min) + ').'
@@ -1571,21 +3677,12 @@ class Analysis :
 
     def illumina_fastq_info(self) :
 
-        self.illumina_length_mean, self.illumina_read_count, self.illumina_bases = 0,0,0
-        opener = 'cat'
-        if re.search('\.(gz|gzip)$', self.illumina_fastq[0]) :
-            opener = 'gunzip -c'
-        for r in range(len(self.illumina_fastq)) :
-            r_fastq = self.illumina_fastq[r]
-            command = ' '.join([opener,
-                                r_fastq,
-                                '| awk \'{getline;s += length($1);getline;getline;}END{print s/NR"\t"NR"\t"s}\''])
-            values = [float(i) for i in re.split('\\t', self.print_and_run(command)[0])]
-            self.illumina_length_mean += values[0]
-            self.illumina_read_count += int(values[1])
-            self.illumina_bases += int(values[2])
-        self.illumina_length_mean /= len(self.illumina_fastq)
-        self.illumina_bases = format_kmg(self.illumina_bases, decimals = 1)
+        self.print_and_log('Getting Illumina read statistics', self.sub_process_verbosity, self.sub_process_color)
+        self.illumina_fastq_stats = fastq_stats(self.illumina_fastq, threads = int(self.step_threads()),
+                                                index_dir = self.read_index_dir())
+        self.illumina_length_mean = self.illumina_fastq_stats['mean_length']
+        self.illumina_read_count = self.illumina_fastq_stats['read_count']
+        self.illumina_bases = format_kmg(self.illumina_fastq_stats['bases'], decimals = 1)
 
             
     def lorma_ont_fastq(self) :
@@ -1594,17 +3691,22 @@ class Analysis :
 
         if not self.ont_fastq_dir :
             self.ont_fastq_dir = os.path.join(self.output_dir, 'ont_fastq')
-            os.makedirs(self.ont_fastq_dir)
+            os.makedirs(self.ont_fastq_dir, exist_ok = True)
         
         # Use lordec-correct to ONT reads
         self.print_and_log('Running LoRMA on the ONT reads', self.sub_process_verbosity, self.sub_process_color)
-        lorma_fasta, lorma_fastq = [os.path.join(self.ont_fastq_dir, 'lorma.' + i) for i in ['fasta', 'fastq']]
+        # Keep the corrected reads compressed if the reads were
+        lorma_fasta = os.path.join(self.ont_fastq_dir, 'lorma.fasta')
+        lorma_fastq = os.path.join(self.ont_fastq_dir, 'lorma.fastq')
+        if all([i.endswith('.gz') for i in read_set_files(self.ont_fastq)]) :
+            lorma_fastq += '.gz'
         lorma_stdout, lorma_stderr = self.std_files(os.path.join(self.ont_fastq_dir, 'lorma'))
+        lorma_input_fastq = self.merged_fastq(self.ont_fastq)
         command = ' '.join(['lordec-correct',
                             '-c -s 4 -k 19 -g',
-                            '-T', str(self.threads),
-                            '-i', self.ont_fastq,
-                            '-2', self.ont_fastq,
+                            '-T', self.step_threads(),
+                            '-i', lorma_input_fastq,
+                            '-2', lorma_input_fastq,
                             '-o', lorma_fasta,
                             '1>', lorma_stdout, '2>', lorma_stderr])
         self.print_and_run(command)
@@ -1614,13 +3716,9 @@ class Analysis :
 
         # Make a FASTQish file from the LoRMA output
         self.print_and_log('Converting LoRMA FASTA to a FASTQ', self.sub_process_verbosity, self.sub_process_color)
-        quality = 25
-        with open(lorma_fasta, 'r') as lorma_fasta_handle, open(lorma_fastq, 'w') as lorma_fastq_handle :
-            for fasta in Bio.SeqIO.parse(lorma_fasta_handle, 'fasta') :
-                 fasta.letter_annotations['phred_quality'] = [quality] * len(fasta)
-                 Bio.SeqIO.write(fasta, lorma_fastq_handle, 'fastq')
+        fasta_to_fastq(lorma_fasta, lorma_fastq, quality = 25)
 
-        self.validate_file_and_size_or_error(lorma_fasta, 'LoRMA FASTQ', 'cannot be found after FASTQ conversion', 'is empty')
+        self.validate_file_and_size_or_error(lorma_fastq, 'LoRMA FASTQ', 'cannot be found after FASTQ conversion', 'is empty')
 
         self.ont_fastq = lorma_fastq
 
@@ -1638,9 +3736,10 @@ class Analysis :
         self.print_and_log('Running minimap2 in all v. all mode', self.sub_process_verbosity, self.sub_process_color)
         self.ont_ava_paf = os.path.join(self.ont_assembly_dir, 'ont_vs_ont.paf')
         stderr_file = os.path.join(self.ont_assembly_dir, 'minimap_ava.stderr')
+        miniasm_fastq = self.merged_fastq(self.ont_fastq)
         command = ' '.join(['minimap2 -x ava-ont',
-                            '-t', str(self.threads),
-                            self.ont_fastq, self.ont_fastq,
+                            '-t', self.step_threads(),
+                            miniasm_fastq, miniasm_fastq,
                             '1>' + self.ont_ava_paf,
                             '2>' + stderr_file])
         self.print_and_run(command)
@@ -1653,7 +3752,7 @@ class Analysis :
         self.ont_miniasm_gfa = os.path.join(self.ont_assembly_dir, 'ont_miniasm.gfa')
         stderr_file = os.path.join(self.ont_assembly_dir, 'miniasm.stderr')
         command = ' '.join(['miniasm -s 1750 -h 1000 -I .5',
-                            '-f ', self.ont_fastq,
+                            '-f ', miniasm_fastq,
                             self.ont_ava_paf,
                             '1>' + self.ont_miniasm_gfa,
                             '2>' + stderr_file])
@@ -1687,8 +3786,8 @@ class Analysis :
         wtdbg2_stdout, wtdbg2_stderr = [os.path.join(self.ont_assembly_dir, 'wtdbg2.' + i) for i in ['stdout', 'stderr']]
         wtdbg2_layout_gz = wtdbg2_prefix + '.ctg.lay.gz'
         command = ' '.join(['wtdbg2',
-                            '-t', str(self.threads),
-                            '-i', self.ont_fastq,
+                            '-t', self.step_threads(),
+                            ' '.join(['-i ' + i for i in read_set_files(self.ont_fastq)]),
                             '-fo', wtdbg2_prefix,
                             '-g', self.genome_assembly_size,
                             '-xont',
@@ -1701,7 +3800,7 @@ class Analysis :
         self.genome_fasta = wtdbg2_prefix + '.fasta'
         wtdbg2_stdout, wtdbg2_stderr = [os.path.join(self.ont_assembly_dir, 'wtpoa.' + i) for i in ['stdout', 'stderr']]
         command = ' '.join(['wtpoa-cns',
-                            '-t', str(self.threads),
+                            '-t', self.step_threads(),
                             '-i', wtdbg2_layout_gz,
                             '-fo', self.genome_fasta,
                             '1>', wtdbg2_stdout,
@@ -1734,12 +3833,12 @@ class Analysis :
         # Actually run Flye
         command = ' '.join(['flye',
                             '--plasmid',
-                            raw_or_corrected, self.ont_fastq,
+                            raw_or_corrected, read_set_arg(self.ont_fastq),
                             '--meta',
                             '--asm-coverage 75',
                             '--genome-size', self.genome_assembly_size,
                             '--out-dir', flye_output_dir,
-                            '--threads', str(self.threads),
+                            '--threads', self.step_threads(),
                             '1>', flye_stdout, '2>', flye_stderr])
         self.print_and_run(command)
         self.validate_file_and_size_or_error(flye_fasta, 'Flye fasta', 'cannot be found after flye', 'is empty')
@@ -1775,36 +3874,47 @@ class Analysis :
         os.makedirs(self.racon_dir)
         self.make_start_file(self.racon_dir)
         
-        # Use RACON to generate a consensus assembly
+        # Use RACON to generate a consensus assembly.  minimap2 and racon both read the same merged reads
+        # file every round, so after the first pass it is served from the page cache.  The alignments are
+        # streamed to racon through a FIFO unless they are kept, gzipped, for debugging.
         self.ont_rva_paf = []
         self.ont_racon_fasta = []
+        racon_fastq = self.merged_fastq(self.ont_fastq_for('racon_ont_assembly'))
 
         input_assembly = self.genome_fasta
         for i in range(0, self.racon_rounds) :
 
-            # Run minimap2 for round 1
-            self.print_and_log('Running minimap2 round' + str(i), self.sub_process_verbosity, self.sub_process_color)
-            ont_rva_paf_i = os.path.join(self.racon_dir, 'ont_rva_' + str(i) + '.paf')
-            self.ont_rva_paf = self.ont_rva_paf + [ont_rva_paf_i]
-            stderr_file = os.path.join(self.racon_dir, 'minimap_rva_' + str(i) + '.stderr')
-            command = ' '.join(['minimap2 -x map-ont -m 10 -t', str(self.threads),
-                                input_assembly, self.ont_fastq,
-                                '1>' + ont_rva_paf_i,
-                                '2>' + stderr_file])
-            self.print_and_run(command)
-            self.validate_file_and_size_or_error(ont_rva_paf_i, 'ONT reads v. assembly PAF', 'cannot be found after minimap2', 'is empty')
+            self.print_and_log('Running minimap2 and racon round ' + str(i), self.sub_process_verbosity, self.sub_process_color)
 
-            # Run racon for round 1
-            self.print_and_log('Running racon round' + str(i), self.sub_process_verbosity, self.sub_process_color)
+            # racon picks its overlap parser from the file extension, so the FIFO needs to look like a PAF
+            ont_rva_fifo_i = os.path.join(self.racon_dir, 'ont_rva_' + str(i) + '.paf')
+            ont_rva_paf_i = ont_rva_fifo_i + '.gz' if self.racon_keep_paf else ont_rva_fifo_i
             ont_racon_fasta_i = os.path.join(self.racon_dir, 'ont_racon_' + str(i) + '.fasta')
             self.ont_racon_fasta = self.ont_racon_fasta + [ont_racon_fasta_i]
-            stderr_file = os.path.join(self.racon_dir, 'racon_' + str(i) + '.stderr')
-            command = ' '.join(['racon -m 8 -x 6 -g -8 -w 500', 
-                                '-t', str(self.threads),
-                                self.ont_fastq, ont_rva_paf_i, input_assembly,
-                                '1>' + ont_racon_fasta_i,
-                                '2>' + stderr_file])
-            self.print_and_run(command)
+            minimap_command = ' '.join(['minimap2 -x map-ont -m 10 -t', self.step_threads(),
+                                        input_assembly, racon_fastq,
+                                        '2>' + os.path.join(self.racon_dir, 'minimap_rva_' + str(i) + '.stderr')])
+            racon_command = ' '.join(['racon -m 8 -x 6 -g -8 -w 500',
+                                      '-t', self.step_threads(),
+                                      racon_fastq, ont_rva_paf_i, input_assembly,
+                                      '1>' + ont_racon_fasta_i,
+                                      '2>' + os.path.join(self.racon_dir, 'racon_' + str(i) + '.stderr')])
+
+            # racon loads every read before it opens the overlaps, by which time minimap2 is blocked on the
+            # FIFO; nothing beyond the pipe buffer ever touches the disk unless we're keeping the PAF
+            os.mkfifo(ont_rva_fifo_i)
+            try :
+                if self.racon_keep_paf :
+                    self.ont_rva_paf = self.ont_rva_paf + [ont_rva_paf_i]
+                    self.print_and_run(self.fifo_command(minimap_command, ont_rva_fifo_i,
+                                                         'gzip -1 <' + ont_rva_fifo_i + ' >' + ont_rva_paf_i))
+                    self.validate_file_and_size_or_error(ont_rva_paf_i, 'ONT reads v. assembly PAF', 'cannot be found after minimap2', 'is empty')
+                    self.print_and_run(racon_command)
+                else :
+                    self.print_and_run(self.fifo_command(minimap_command, ont_rva_fifo_i, racon_command))
+            finally :
+                os.remove(ont_rva_fifo_i)
+
             self.validate_file_and_size_or_error(ont_racon_fasta_i, 'ONT racon assembly', 'cannot be found after racon', 'is empty')
 
             input_assembly = ont_racon_fasta_i
@@ -1823,6 +3933,16 @@ class Analysis :
         self.make_finish_file(self.racon_dir)
 
         
+    def fifo_command(self, writer, fifo, reader) :
+
+        # Run writer into the FIFO alongside reader, failing if either fails.  A reader that dies before
+        # opening the FIFO would leave the writer waiting on it forever, so the writer is stopped then.
+        return ' '.join([writer, '1>' + fifo, '& writer_pid=$! ;',
+                         reader, '; reader_status=$? ;',
+                         'if [ $reader_status -ne 0 ] ; then kill $writer_pid 2>/dev/null ; fi ;',
+                         'wait $writer_pid && [ $reader_status -eq 0 ]'])
+
+        
     def medaka_ont_assembly(self) :
 
         self.print_and_log('Running Medaka on ONT assembly', self.main_process_verbosity, self.main_process_color)
@@ -1835,12 +3955,17 @@ class Analysis :
         self.print_and_log('Starting medaka', self.sub_process_verbosity, self.sub_process_color)
         self.medaka_fasta = os.path.join(self.medaka_dir, 'consensus.fasta')
         medaka_stdout, medaka_stderr = self.std_files(os.path.join(self.medaka_dir, 'medaka'))
+
+        # Medaka wants uncorrected reads, so a subset (made from the reads we have) only applies without --error-correct
+        medaka_fastq = self.ont_raw_fastq
+        if self.ont_fastq == self.ont_raw_fastq :
+            medaka_fastq = self.ont_fastq_for('medaka_ont_assembly')
         command = ' '.join(['medaka_consensus',
                             '-m', 'r941_min_high_g360',
-                            '-i', self.ont_raw_fastq,
+                            '-i', self.merged_fastq(medaka_fastq),
                             '-d', self.genome_fasta,
                             '-o', self.medaka_dir,
-                            '-t', str(self.threads),
+                            '-t', self.step_threads(),
                             '1>' + medaka_stdout, '2>' + medaka_stderr])
         self.print_and_run(command)
         self.validate_file_and_size_or_error(self.medaka_fasta, 'Medaka FASTA', 'cannot be found after Medaka', 'is empty')
@@ -1873,11 +3998,13 @@ class Analysis :
 
         self.nanopolish_dir = os.path.join(self.output_dir, 'nanopolish')
         os.makedirs(self.nanopolish_dir)
+        self.make_start_file(self.nanopolish_dir)
 
         # Map the ONT reads against the genome
         self.print_and_log('Mapping ONT reads to the genome assembly', self.sub_process_verbosity, self.sub_process_color)
         self.nanopolish_bam = os.path.join(self.nanopolish_dir, 'minimap.bam')
-        self.minimap_ont_fastq(self.genome_fasta, self.ont_fastq, self.nanopolish_bam)
+        self.nanopolish_fastq = self.merged_fastq(self.ont_fastq)
+        self.minimap_ont_fastq(self.genome_fasta, self.nanopolish_fastq, self.nanopolish_bam)
         self.index_bam(self.nanopolish_bam)
         
         # Find the coverage of each contig to see if we need to downsample
@@ -1933,7 +4060,7 @@ class Analysis :
         command = ' '.join(['nanopolish index',
                             '-d', self.ont_fast5,
                             '-f', self.albacore_seq_files_file,
-                            self.ont_fastq,
+                            self.nanopolish_fastq,
                             '1>' + index_stdout,
                             '2>' + index_stderr])
         self.print_and_run(command)
@@ -1948,8 +4075,10 @@ class Analysis :
 
         # Run the ranges in parallel
         self.nanopolish_stdout, self.nanopolish_stderr = [os.path.join(self.nanopolish_dir, 'nanopolish.' + i) for i in ['stdout', 'stderr']]
-        pool = mp.Pool(processes = self.threads)
-        results = pool.map(self.run_nanopolish_range, nanopolish_ranges)
+        # Each range runs nanopolish single-threaded, so the pool width is the step's whole lease.  The ranges are
+        # just commands, so threads will do, and unlike processes they work inside a barcode's pool worker.
+        with concurrent.futures.ThreadPoolExecutor(max_workers = int(self.step_threads())) as executor :
+            results = list(executor.map(self.run_nanopolish_range, nanopolish_ranges))
 
 
         # Merget the nanopolish results
@@ -1964,6 +4093,8 @@ class Analysis :
         self.genome_fasta = self.nanopolish_fasta
 
         self.load_genome()
+
+        self.make_finish_file(self.nanopolish_dir)
         
 
     def run_nanopolish_range(self, nanopolish_range) :
@@ -1974,7 +4105,7 @@ class Analysis :
             command = ' '.join(['nanopolish variants --faster --consensus',
                                 '-o', nanopolish_vcf,
                                 '-w', nanopolish_range,
-                                '-r', self.ont_fastq,
+                                '-r', self.nanopolish_fastq,
                                 '-b', self.nanopolish_bam,
                                 '-g', self.genome_fasta,
                                 '-t 1 --min-candidate-frequency 0.1',
@@ -2007,7 +4138,7 @@ class Analysis :
         command = ' '.join(['spades.py',
                             fastq_input,
                             '-o', self.spades_dir,
-                           '-t', str(self.threads),
+                           '-t', self.step_threads(),
                             '--careful -k auto',
                             '1>' + spades_stdout, '2>' + spades_stderr])
         self.print_and_run(command)
@@ -2148,7 +4279,7 @@ class Analysis :
         if self.ont_fastq :
             
             coverage_bam = os.path.join(self.info_dir, 'ont_coverage.bam')
-            self.minimap_ont_fastq(self.genome_fasta, self.ont_fastq, coverage_bam)
+            self.minimap_ont_fastq(self.genome_fasta, self.ont_fastq_stream('assembly_info'), coverage_bam)
             self.files_to_clean += [coverage_bam]
             
             coverage_tsv = os.path.join(self.info_dir, 'ont_coverage.tsv')
@@ -2161,6 +4292,13 @@ class Analysis :
             self.contig_info['ONT'] = pandas.read_csv(coverage_tsv, header = None, index_col = None, sep = '\t').sort_values(1, axis = 0, ascending = False)
             self.contig_info['ONT'].columns = ['contig', 'size', 'coverage']
 
+            # With --info-depth we only mapped a subset, so scale its coverage up to what all of the reads give
+            coverage_scale = self.ont_fastq_subset_scales.get(self.ont_fastq_for('assembly_info'), 1)
+            if coverage_scale != 1 :
+                self.print_and_log('Scaling ONT coverage of the {:s} subset by {:.2f} to all of the reads'.format(
+                    os.path.basename(self.ont_fastq_for('assembly_info')), coverage_scale), self.sub_process_verbosity, self.sub_process_color)
+                self.contig_info['ONT']['coverage'] = (self.contig_info['ONT']['coverage'] * coverage_scale).round()
+
             mean_coverage = (self.contig_info['ONT'].iloc[:, 1] * self.contig_info['ONT'].iloc[:, 2]).sum() / self.contig_info['ONT'].iloc[:, 1].sum()
             
             if mean_coverage <= self.ont_coverage_min :
@@ -2232,14 +4370,99 @@ class Analysis :
         
     def make_blast_database(self, database_fasta) :
 
-        self.print_and_log('Making a BLAST database for ' + database_fasta, self.sub_process_verbosity, self.sub_process_color)
-        std_prefix = re.sub('\.[^.]*$', '', database_fasta)
-        stdout_file, stderr_file = self.std_files(std_prefix)
-        command = ' '.join(['makeblastdb -in', database_fasta, '-dbtype nucl -parse_seqids',
-                            '1>' + stdout_file, '2>' + stderr_file])
-        self.print_and_run(command)
+        # Shared databases (e.g., plasmids) only need to be built once, and by one analysis at a time
+        with shared_file_lock(database_fasta) :
+            if any([is_up_to_date(database_fasta + i, database_fasta) for i in ['.nsq', '.00.nsq']]) :
+                self.print_and_log('Using existing BLAST database for ' + database_fasta, self.sub_process_verbosity, self.sub_process_color)
+                return
+
+            self.print_and_log('Making a BLAST database for ' + database_fasta, self.sub_process_verbosity, self.sub_process_color)
+            std_prefix = re.sub('\.[^.]*$', '', database_fasta)
+            stdout_file, stderr_file = self.std_files(std_prefix)
+            command = ' '.join(['makeblastdb -in', database_fasta, '-dbtype nucl -parse_seqids',
+                                '1>' + stdout_file, '2>' + stderr_file])
+            self.print_and_run(command)
+
+
+    def minimap_index(self, fasta, preset) :
 
+        # Index a shared FASTA (e.g., the reference) once for all analyses, next to the FASTA if we can write there
+        mmi = fasta + '.' + preset + '.mmi'
+        if not os.access(os.path.dirname(os.path.abspath(fasta)), os.W_OK) :
+            return(fasta)
         
+        with shared_file_lock(mmi) :
+            if not is_up_to_date(mmi, fasta) :
+                self.print_and_log('Making a minimap2 index of ' + fasta, self.sub_process_verbosity, self.sub_process_color)
+                command = ' '.join(['minimap2 -x', preset,
+                                    '-d', mmi + '.tmp',
+                                    fasta,
+                                    '1>/dev/null 2>/dev/null'])
+                self.print_and_run(command)
+                if not self.fake_run :
+                    os.replace(mmi + '.tmp', mmi)
+        return(mmi)
+
+        
+    def screen_ont_reads(self) :
+
+        self.print_and_log('Screening ONT reads for features', self.main_process_verbosity, self.main_process_color)
+
+        self.read_screen_dir = os.path.join(self.output_dir, 'read_screen')
+        os.makedirs(self.read_screen_dir)
+        self.make_start_file(self.read_screen_dir)
+
+        read_screen = ReadScreen()
+        self.screen_reads(self.ont_fastq_stream('screen_ont_reads'), read_screen)
+        self.read_screen_hits = self.save_read_screen(read_screen, self.read_screen_dir)
+
+        self.make_finish_file(self.read_screen_dir)
+
+
+    def screen_reads(self, fastq, read_screen) :
+
+        # Stream the reads' alignments to each feature set straight into the screen.  The feature sets are
+        # mapped at the same time, sharing one pass over the reads.
+        feature_sets = [re.sub('\\.f.*', '', os.path.basename(i)) for i in self.feature_fastas]
+        feature_mmis = [self.minimap_index(i, 'map-ont') for i in self.feature_fastas]
+        if len(feature_sets) == 1 :
+            feature_fastqs = [read_set_arg(fastq)]
+        else :
+            fanout = ReadFanout(fastq, feature_sets, os.path.join(self.output_dir, 'read_streams', getattr(step_context, 'step', None) or 'screen'))
+            feature_fastqs = [fanout.pipe(i) for i in feature_sets]
+        threads = str(max(1, int(self.step_threads()) // len(feature_sets)))
+
+        def screen_feature_set(feature_set, feature_mmi, feature_fastq) :
+            command = ' '.join(['minimap2 -x map-ont --secondary=no',
+                                '-t', threads,
+                                feature_mmi,
+                                feature_fastq,
+                                '2>/dev/null'])
+            try :
+                self.print_and_run(command, consumer = lambda line : read_screen.add_alignment(feature_set, line))
+            finally :
+                if len(feature_sets) > 1 :
+                    fanout.release(feature_set)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = len(feature_sets)) as executor :
+            screens = [executor.submit(screen_feature_set, *i) for i in zip(feature_sets, feature_mmis, feature_fastqs)]
+        for screen in screens :
+            screen.result()
+
+
+    def save_read_screen(self, read_screen, read_screen_dir) :
+
+        read_screen_hits = read_screen.hits()
+        read_screen_hits.to_csv(os.path.join(read_screen_dir, 'read_screen.tsv'), sep = '\t', index = False,
+                                float_format = '%.2f')
+        for feature_set, feature_set_hits in read_screen_hits.groupby('feature_set') :
+            self.print_and_log('Reads support ' + feature_set + ' features ' +
+                               ', '.join([feature + ' ({:.1f}X)'.format(depth) for feature, depth in
+                                          zip(feature_set_hits['feature'], feature_set_hits['depth'])]),
+                               self.sub_process_verbosity, self.sub_process_color)
+        return read_screen_hits
+
+
     def blast_feature_sets(self) :
 
         self.print_and_log('BLASTing feature sets', self.main_process_verbosity, self.main_process_color)
@@ -2354,12 +4577,12 @@ class Analysis :
         command = ' '.join(['grep AvgIdentity', dnadiff_report,
                             '| head -1',
                             '| awk \'{print $2}\''])
-        self.reference_identity = float(self.print_and_run(command)[0])
+        self.reference_identity = float(self.print_and_run(command, max_lines = 1)[0])
 
         command = ' '.join(['grep AlignedBases', dnadiff_report,
                             '| head -1',
                             '| awk \'{sub("\\\\(.*", "", $2);print $2}\''])
-        self.reference_aligned_bases = int(self.print_and_run(command)[0]) * 100
+        self.reference_aligned_bases = int(self.print_and_run(command, max_lines = 1)[0]) * 100
 
         # Figure out the aligned fraction
         self.reference_aligned_fraction = self.reference_aligned_bases / self.reference_size
@@ -2594,10 +4817,11 @@ class Analysis :
         # Map the reads to the reference sequence
         self.reference_mapping_bam = os.path.join(self.mutations_dir, 'reference_mapping.bam')
         if self.illumina_fastq :
-            self.minimap_illumina_fastq(self.reference_fasta, self.illumina_fastq, self.reference_mapping_bam)
+            self.minimap_illumina_fastq(self.minimap_index(self.reference_fasta, 'sr'), self.illumina_fastq, self.reference_mapping_bam)
             kind_of_reads = 'Illumina'
         else :
-            self.minimap_ont_fastq(self.reference_fasta, self.ont_fastq, self.reference_mapping_bam)
+            self.minimap_ont_fastq(self.minimap_index(self.reference_fasta, 'map-ont'), self.ont_fastq_stream('call_amr_mutations'),
+                                   self.reference_mapping_bam)
             kind_of_reads = 'ONT'
         self.index_bam(self.reference_mapping_bam)
 
@@ -2734,7 +4958,7 @@ class Analysis :
         minimap_stdout, minimap_stderr = self.std_files(os.path.join(self.plasmid_dir, 'minimap'))
         command = ' '.join(['minimap2',
                             '-k 20 -p .2 -a',
-                            '-t', str(self.threads),
+                            '-t', self.step_threads(),
                             self.genome_fasta,
                             self.plasmid_database,
                             '1>', plasmid_sam,
@@ -2777,7 +5001,7 @@ class Analysis :
                             '--output', self.pchunks_dir,
                             '--no-amr', '--no-inc',
                             '--plasmid-database', self.plasmid_database,
-                            '--threads', str(self.threads),
+                            '--threads', self.step_threads(),
                             '1>' + stdout_file, '2>' + stderr_file])
         self.print_and_run(command)
         self.validate_file_and_size_or_error(self.plasmid_tsv, 'Plasmid output table', 'cannot be found', 'is empty')
@@ -2960,10 +5184,14 @@ class Analysis :
         
         self.report_dir = os.path.join(self.output_dir, 'report')
         os.mkdir(self.report_dir)
+        self.make_start_file(self.report_dir)
 
         self.report_prefix = os.path.join(self.report_dir, 'report')
         self.report_tex = self.report_prefix + '.tex'
         self.report_pdf = self.report_prefix + '.pdf'
+
+        if self.ont_raw_fastq :
+            self.ont_raw_fastq_label = read_set_label(self.ont_raw_fastq)
         
         self.latex_report = PimaReport(self)
         self.latex_report.make_report()
@@ -2984,6 +5212,8 @@ class Analysis :
 
         self.validate_file_and_size_or_error(self.report_pdf, 'Report TEX', 'cannot be found', 'is empty')
 
+        self.make_finish_file(self.report_dir)
+
         
     def clean_up(self) :
 
@@ -2994,33 +5224,305 @@ class Analysis :
 
         if len(self.files_to_clean) > 1 :
             for file in self.files_to_clean :
-                command = 'rm ' + file
+                command = 'rm -f ' + file
                 self.print_and_run(command)
 
             
+    def step_threads(self, share = 1) :
+
+        # Threads for a tool run by the current step, from the step's lease.  A share below 1 is for
+        # helpers piped alongside the main tool (e.g., samtools sort behind minimap2).
+        threads = getattr(step_context, 'threads', None) or self.threads
+        return str(max(1, int(threads * share)))
+
+
+    def step_name(self, step) :
+
+        if type(step) is list :
+            return step[0]
+        return step
+
+
+    def steps_conflict(self, step, earlier_step) :
+
+        step, earlier_step = analysis_steps.get(self.step_name(step)), analysis_steps.get(self.step_name(earlier_step))
+
+        # Anything we don't know about gets run on its own
+        if step is None or earlier_step is None :
+            return True
+        if step.get('barrier') or earlier_step.get('barrier') :
+            return True
+
+        inputs, outputs = set(step.get('inputs', [])), set(step.get('outputs', []))
+        earlier_inputs, earlier_outputs = set(earlier_step.get('inputs', [])), set(earlier_step.get('outputs', []))
+
+        # Wait on anything that writes what we read, or reads/writes what we write
+        return len(inputs & earlier_outputs) > 0 or len(outputs & (earlier_inputs | earlier_outputs)) > 0
+
+
+    def run_step(self, step, threads = None) :
+
+        step_context.step = self.step_name(step)
+        step_context.max_rss_kb = 0
+        step_info = analysis_steps.get(self.step_name(step), {})
+        input_bytes = sum([path_bytes(getattr(self, i, None)) for i in step_info.get('inputs', [])])
+        start_time = time.time()
+        start_usage = resource.getrusage(resource.RUSAGE_THREAD)
+
+        # Note what the step is about to change, so a save_state() while it's running can leave that out
+        self.running_step_states[self.step_name(step)] = self.capture_step_state(self.step_name(step))
+
+        # Barriers run alone, so don't hold threads back from anything they start
+        if not analysis_steps.get(self.step_name(step), {}).get('barrier') :
+            step_context.threads = self.thread_budget.lease(threads or self.threads)
+        try :
+            if 'matplotlib' in analysis_steps.get(self.step_name(step), {}).get('outputs', []) :
+                with plot_lock :
+                    self.run_step_function(step)
+            else :
+                self.run_step_function(step)
+
+            # What the step produced, the only things --resume brings back from the saved state
+            produced = self.running_step_states[self.step_name(step)]['written'] | set(step_info.get('outputs', []))
+        finally :
+            if getattr(step_context, 'threads', None) :
+                self.thread_budget.release(step_context.threads)
+                step_context.threads = None
+            self.running_step_states.pop(self.step_name(step), None)
+            step_context.written = None
+            if self.step_name(step) in self.read_fanouts :
+                self.read_fanouts.pop(self.step_name(step)).release(self.step_name(step))
+            end_usage = resource.getrusage(resource.RUSAGE_THREAD)
+            end_time = time.time()
+            self.add_trace({'type' : 'step',
+                            'start' : start_time,
+                            'end' : end_time,
+                            'wall' : end_time - start_time,
+                            'python_user' : end_usage.ru_utime - start_usage.ru_utime,
+                            'python_sys' : end_usage.ru_stime - start_usage.ru_stime,
+                            'input_bytes' : input_bytes,
+                            'disk_bytes' : path_bytes(os.path.join(self.output_dir, step_info['dir'])) if 'dir' in step_info else 0,
+                            'max_rss_kb' : step_context.max_rss_kb})
+            step_context.step = None
+
+        return(produced)
+
+
+    def run_step_function(self, step) :
+
+        ## See if we have arguments to pass to our function
+        arguments = []
+        if type(step) is list :
+            arguments = step[1:]
+            step = step[0]
+        function = getattr(self, step)
+
+        # See if we have already done this exact step before
+        if not (self.cache_dir and analysis_steps.get(step, {}).get('cache')) or self.fake_run :
+            function(*arguments)
+            return
+
+        cache_key = self.step_cache_key(step)
+        if self.restore_cached_step(step, cache_key) :
+            return
+
+        before = self.running_step_states[step]
+        function(*arguments)
+        self.store_cached_step(step, cache_key, before)
+
+
     def go(self) :
 
-        analysis_string = '\n'.join([str(i+1) + ') ' + self.analysis[i] for i in range(len(self.analysis))])
+        if self.fake_run :
+            self.plan_analysis()
+            return
+
+        analysis_string = '\n'.join([str(i+1) + ') ' + self.step_name(self.analysis[i]) for i in range(len(self.analysis))])
         print(self.main_process_color + analysis_string + Colors.ENDC)
-        
-        while (True) :
-            step = self.analysis[0]
-            self.analysis = self.analysis[1:]
-            
-            ## See if we have arguments to pass to our function
-            if type(step) is list :
-                arguments = []
-                if len(step) > 1 :
-                    arguments = step[1:]
-                step = step[0]
-                function = getattr(self, step)
-                function(*arguments)
-            else :
-                function = getattr(self, step)
-                function()
 
-            if (len(self.analysis) == 0) :
-                break
+        # self.analysis holds the steps that haven't been started yet.  Steps may replace it
+        # (e.g., qcat_ont_fastq when there are several barcodes), so always go back to it.
+        running = {}
+        plan = self.analysis
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.max_parallel_steps)
+        try :
+
+            while len(self.analysis) > 0 or len(running) > 0 :
+
+                # Split the threads evenly between what's running and what's about to start
+                ready_count = len([step for i, step in enumerate(self.analysis[:self.max_parallel_steps])
+                                   if not any([self.steps_conflict(step, earlier_step)
+                                               for earlier_step in list(running.values()) + self.analysis[:i]])])
+                step_threads = max(1, self.threads // max(1, min(len(running) + ready_count, self.max_parallel_steps)))
+
+                # Start every step that doesn't depend on an unfinished step before it
+                i = 0
+                starting = []
+                while i < len(self.analysis) and len(running) + len(starting) < self.max_parallel_steps :
+                    step = self.analysis[i]
+                    earlier_steps = list(running.values()) + starting + self.analysis[:i]
+                    if any([self.steps_conflict(step, earlier_step) for earlier_step in earlier_steps]) :
+                        i += 1
+                        continue
+                    del self.analysis[i]
+
+                    # With --resume, skip anything that finished last time, picking up any plan it made
+                    if self.resume and self.step_is_finished(step) :
+                        self.print_and_log('Skipping ' + self.step_name(step) + ', finished in a previous run',
+                                           self.main_process_verbosity, self.main_process_color)
+                        if self.step_name(step) in self.plan_rewrites :
+                            self.analysis = list(self.plan_rewrites[self.step_name(step)])
+                            plan = self.analysis
+                            i = 0
+                        continue
+                    if self.resume :
+                        self.clear_unfinished_step(step)
+
+                    starting += [step]
+
+                self.start_read_fanouts(starting)
+                for step in starting :
+                    running[executor.submit(self.run_step, step, step_threads)] = step
+
+                if len(running) == 0 :
+                    continue
+
+                done, not_done = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done :
+                    step = running.pop(future)
+                    # Raises any error from the step (including error_out()'s exit) here
+                    self.produced_attributes = self.produced_attributes | future.result()
+
+                    # Keep track of what's done, and whether the step replaced the rest of the plan
+                    if not self.step_name(step) in self.finished_steps :
+                        self.finished_steps += [self.step_name(step)]
+                    if not self.analysis is plan :
+                        self.plan_rewrites[self.step_name(step)] = list(self.analysis)
+                        plan = self.analysis
+                    self.save_state()
+
+        except BaseException :
+            # Don't wait for the rest of the plan, or for the steps still running, before exiting
+            self.stop_running_steps([running[future] for future in running if not future.done()])
+            executor.shutdown(wait = False, cancel_futures = True)
+            raise
+        executor.shutdown()
+
+        self.log_trace_summary()
+
+
+    def stop_running_steps(self, steps) :
+
+        if len(steps) == 0 :
+            return
+        self.print_and_log('Stopping ' + ', '.join([self.step_name(step) for step in steps]) + ', which were still running',
+                           0, Colors.FAIL)
+        for step in steps :
+            for process in list(self.step_processes.get(self.step_name(step), [])) :
+                try :
+                    os.killpg(process.pid, signal.SIGTERM)
+                except OSError : # Already gone
+                    pass
+
+
+
+def run_barcode_analysis(arguments) :
+
+    # Runs one barcode's analysis in a pool worker, from the options and the multiplexed analysis's settings.
+    # Given a list of steps (e.g., a provisional analysis during --ont-watch), runs just those, unvalidated.
+    opts, settings = arguments[:2]
+    barcode_analysis = Analysis(opts, [])
+    for name, value in settings.items() :
+        setattr(barcode_analysis, name, value)
+    barcode_analysis.thread_budget = ThreadBudget(barcode_analysis.threads)
+
+    # Terminating the pool (e.g., once the watch is over, for a provisional analysis nobody needs anymore) only
+    # kills the worker, so take the tools, which run in their own process groups, down with it
+    def stop_analysis(signal_number, frame) :
+        barcode_analysis.stop_running_steps(list(barcode_analysis.step_processes.keys()))
+        os._exit(1)
+    signal.signal(signal.SIGTERM, stop_analysis)
+
+    try :
+        if len(arguments) > 2 :
+            barcode_analysis.analysis = list(arguments[2])
+        else :
+            barcode_analysis.validate_options()
+        barcode_analysis.feature_fastas = settings['feature_fastas']
+        if len(barcode_analysis.analysis) > 0 :
+            barcode_analysis.go()
+    except SystemExit :
+        # Exiting would take down the pool worker and leave the map waiting on it forever
+        return False
+    except Exception as exception :
+        # Nor should one barcode's bug take down every other barcode with it
+        barcode_analysis.print_and_log('Analysis in ' + barcode_analysis.output_dir + ' failed: ' + repr(exception),
+                                       0, Colors.FAIL)
+        return False
+    return True
+
+
+
+def run_sample_sheet(opts, unknown_args) :
+
+    # Each row of the sample sheet is its own analysis in --output/<name>; everything else comes from the command line
+    sample_sheet = pandas.read_csv(opts.sample_sheet, sep = '\t', header = 0, dtype = str, keep_default_na = False)
+    errors = []
+    if not 'name' in sample_sheet.columns :
+        errors += ['Sample sheet ' + opts.sample_sheet + ' needs a name column']
+    elif sample_sheet['name'].duplicated().any() :
+        errors += ['Sample names in ' + opts.sample_sheet + ' must be unique']
+    if not opts.output :
+        errors += ['No output directory given (--output)']
+    if opts.download :
+        errors += ['Run --download on its own before using --sample-sheet']
+
+    analyses = []
+    if len(errors) == 0 :
+        thread_budget = ThreadBudget(opts.threads)
+        for sample_i, sample in sample_sheet.iterrows() :
+            sample_opts = Namespace(**vars(opts))
+            sample_opts.name = sample['name']
+            sample_opts.output = os.path.join(opts.output, sample['name'])
+            if sample.get('ont_fastq') :
+                sample_opts.ont_fastq = sample['ont_fastq']
+            if sample.get('illumina_fastq') :
+                sample_opts.illumina_fastq = re.split('[, ]+', sample['illumina_fastq'])
+            if sample.get('organism') :
+                sample_opts.organism = sample['organism']
+            if sample.get('features') :
+                sample_opts.feature = (opts.feature or []) + re.split('[, ]+', sample['features'])
+
+            analysis = Analysis(sample_opts, unknown_args)
+            analysis.thread_budget = thread_budget
+            analysis.validate_options()
+            errors += [sample['name'] + ': ' + i for i in analysis.errors]
+            analyses += [analysis]
+
+    if len(errors) > 0 :
+        print(Colors.FAIL + '\n\nErrors:')
+        [print(i) for i in errors]
+        print(Colors.ENDC)
+        print('Use --help to see options')
+        sys.exit()
+
+    os.makedirs(opts.output, exist_ok = True)
+
+    # The samples share the thread budget, so together they stay within --threads
+    def run_sample(analysis) :
+        try :
+            analysis.go()
+        except SystemExit :
+            return False
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, min(len(analyses), opts.max_parallel_steps))) as executor :
+        results = list(executor.map(run_sample, analyses))
+
+    failed_samples = [analysis.analysis_name for analysis, result in zip(analyses, results) if not result]
+    if len(failed_samples) > 0 :
+        print(Colors.FAIL + 'Analysis of ' + ', '.join(failed_samples) + ' failed' + Colors.ENDC)
+        sys.exit(1)
 
             
 def main(opts) :
@@ -3055,16 +5557,26 @@ if __name__ == '__main__':
                         help = 'Maxmium time to watch for new reads.' )
     input_group.add_argument('--ont-watch-between-time', required = False, type = float, default = 15, metavar = '<MINUTES>',
                         help = 'Maximum to to wait between new FAST5 files')
+    input_group.add_argument('--ont-watch-depth', required = False, type = float, default = None, metavar = '<DEPTH>',
+                        help = 'Stop watching once the basecalled reads reach this depth of --genome-size (default : %(default)s)')
+    input_group.add_argument('--ont-watch-n50', required = False, type = int, default = None, metavar = '<BP>',
+                        help = 'Stop watching once the read N50 reaches this, given at least 30X depth (default : %(default)s)')
+    input_group.add_argument('--ont-watch-batch-files', required = False, type = int, default = 200, metavar = '<INT>',
+                        help = 'Basecall new FAST5 files once this many are waiting (default : %(default)s)')
+    input_group.add_argument('--ont-watch-batch-time', required = False, type = float, default = 10, metavar = '<MINUTES>',
+                        help = 'Basecall new FAST5 files once the oldest has waited this long (default : %(default)s)')
+    input_group.add_argument('--ont-watch-provisional', required = False, type = float, default = None, metavar = '<MINUTES>',
+                        help = 'While watching, assemble and look for features in the reads so far this often (default : %(default)s)')
     input_group.add_argument('--ont-fast5', required = False, default = None, metavar = '<ONT_DIR>',
                         help = 'Directory containing ONT FAST5 files')
     input_group.add_argument('--ont-fast5-limit', required = False, type = int, default = None, metavar = '<DIR_COUNT>',
                         help = 'Limit on the number of FAST5 directories to include in the analysis (default : all dirs)')
     input_group.add_argument('--basecaller', required = False, default = 'guppy', choices = ['guppy', 'albacore'],
                         help = 'The basecaller for ONT FAST5 data (default : %(default)s)')
-    input_group.add_argument('--ont-fastq', required = False, default = None, metavar = '<FASTQ|GZ>',
-                        help = 'File containing basecalled ONT reads')
+    input_group.add_argument('--ont-fastq', required = False, default = None, metavar = '<FASTQ|GZ|DIR|GLOB>',
+                        help = 'Basecalled ONT reads: a FASTQ (optionally gzipped), or a directory or glob of FASTQ chunks')
     input_group.add_argument('--multiplexed', required = False, default = False, action = 'store_true',
-                        help = 'The ONT data are multiplexed (default : %(default)s)')
+                        help = 'The ONT data are multiplexed; with --ont-watch, the watch targets apply to each barcode (default : %(default)s)')
     input_group.add_argument('--demux', required = False, default = 'qcat', choices = ['qcat', 'porechop'],
                         help = 'Demultiplexer/trimmer to use (default : %(default)s)')
     input_group.add_argument('--error-correct', required = False, default = False, action = 'store_true',
@@ -3077,6 +5589,8 @@ if __name__ == '__main__':
 
     input_group.add_argument('--genome', required = False, default = None, metavar = '<GENOME_FASTA>',
                         help = 'A genome FASTA file to be used in place of assembly')
+    input_group.add_argument('--sample-sheet', required = False, default = None, metavar = '<TSV>',
+                        help = 'Analyze each sample (columns name, ont_fastq, illumina_fastq, organism, features) into --output/<name>')
 
     
     output_group = parser.add_argument_group('Output options')
@@ -3084,6 +5598,10 @@ if __name__ == '__main__':
                         help = 'Output directory for the analysis')
     output_group.add_argument('--overwrite', required = False, default = False, action = 'store_true',
                         help = 'Overwrite an existing output directory (default : %(default)s)')
+    output_group.add_argument('--cache-dir', required = False, default = None, metavar = '<CACHE_DIR>',
+                        help = 'Reuse results of earlier runs on the same inputs from this directory (default : %(default)s)')
+    output_group.add_argument('--resume', required = False, default = False, action = 'store_true',
+                        help = 'Continue an interrupted analysis in --output, skipping finished steps (default : %(default)s)')
 
     
     # Assembly options
@@ -3092,11 +5610,13 @@ if __name__ == '__main__':
                         choices = ['miniasm', 'wtdbg2', 'flye'],
                         help = 'Assembler to use (default : %(default)s)')
     assembly_group.add_argument('--genome-size', required = False, default = None, type = str, metavar = '<GENOME_SIZE>',
-                        help = 'Genome size estimate for Flye (default : %(default)s))')
+                        help = 'Genome size estimate for Flye/wtdbg2 (default : estimated from ONT read k-mers)')
     assembly_group.add_argument('--racon', required = False, default = False, action = 'store_true',
                         help = 'Force the generation a racon consenus (default : %(default)s)')
     assembly_group.add_argument('--racon-rounds', required = False, default = 4, type = int, metavar = '<NUM_ROUNDS>',
                         help = 'Number of RACON rounds used to generate a consensus (default : %(default)s)')
+    assembly_group.add_argument('--racon-keep-paf', required = False, default = False, action = 'store_true',
+                        help = 'Keep each RACON round\'s read alignments as gzipped PAF instead of streaming them (default : %(default)s)')
     assembly_group.add_argument('--no-medaka', required = False, default = False, action = 'store_true',
                         help = 'Skip Medaka polising of the ONT assembly (faster) (default : %(default)s)')
     assembly_group.add_argument('--nanopolish', required = False, default = False, action = 'store_true',
@@ -3105,6 +5625,14 @@ if __name__ == '__main__':
                         help = 'Maximum coverage before downsampling nanopolish input (default : %(default)s)')
     assembly_group.add_argument('--albacore-seq-file', required = False, type = str, default = None, metavar = '<ALBACORE_SEQ_FILE>',
                         help = 'List of albacore sequencing summary files for nanopolish (default : %(default)s)')
+    assembly_group.add_argument('--racon-depth', required = False, default = None, type = float, metavar = '<DEPTH>',
+                        help = 'Give racon the best ONT reads up to this depth (default : all reads)')
+    assembly_group.add_argument('--medaka-depth', required = False, default = None, type = float, metavar = '<DEPTH>',
+                        help = 'Give Medaka the best ONT reads up to this depth (default : all reads)')
+    assembly_group.add_argument('--info-depth', required = False, default = None, type = float, metavar = '<DEPTH>',
+                        help = 'Measure ONT coverage with the best reads up to this depth (default : all reads)')
+    assembly_group.add_argument('--mutation-depth', required = False, default = None, type = float, metavar = '<DEPTH>',
+                        help = 'Call AMR mutations from the best ONT reads up to this depth (default : all reads)')
     assembly_group.add_argument('--pilon', required = False, default = False, action = 'store_true',
                         help = 'Run Pilon if Illumina reads are given (default : %(default)s)')
     assembly_group.add_argument('--no-assembly', required = False, default = False, action = 'store_true',
@@ -3144,6 +5672,8 @@ if __name__ == '__main__':
     other_feature_group = parser.add_argument_group('Other feature search options')
     other_feature_group.add_argument('--feature', required = False, default = None, metavar = '<FEATURE_FASTA>', action = 'append',
                                      help = 'Path to a FASTA file with feature sequences')
+    other_feature_group.add_argument('--read-screen', required = False, default = False, action = 'store_true',
+                                     help = 'Screen the ONT reads for features before assembly (default : %(default)s)')
     
     
     # Drawing options
@@ -3172,12 +5702,20 @@ if __name__ == '__main__':
                              help = 'Name of this analysis for reporting.')
     other_group.add_argument('--threads', required = False, type=int, default = 1, metavar = '<NUM_THREADS>',
                         help = 'Number of worker threads to use (default : %(default)s)')
+    other_group.add_argument('--max-parallel-steps', required = False, type = int, default = 4, metavar = '<INT>',
+                        help = 'Maximum number of independent analysis steps to run at once (default : %(default)s)')
+    other_group.add_argument('--stream-reads', required = False, default = False, action = 'store_true',
+                        help = 'Read the ONT reads once, through named pipes, for steps that start together (default : %(default)s)')
     other_group.add_argument('--verbosity', required = False, type=int, default = 1, metavar = '<INT>',
                         help = 'How much information to print as PIMA runs (default : %(default)s)')
     other_group.add_argument('--bundle', required = False, type=str, default = None, metavar = '<PATH>',
                         help = 'Local Tectonic bundle (default : %(default)s)')
     other_group.add_argument('--fake-run', required = False, default = False, action = 'store_true',
-                             help = 'Don\'t actually run the pipeline, just pretend to (default : %(default)s)')
+                             help = 'Don\'t actually run the pipeline, just estimate its time, disk and memory (default : %(default)s)')
+    other_group.add_argument('--calibration', required = False, default = [], nargs = '+', metavar = '<TRACE|DIR>',
+                             help = 'trace.jsonl files, or directories of earlier runs, to base --fake-run estimates on')
+    other_group.add_argument('--plan-json', required = False, default = None, metavar = '<JSON>',
+                             help = 'Also write the --fake-run plan and totals to this file (default : %(default)s)')
 
     
     opts, unknown_args = parser.parse_known_args()
@@ -3192,6 +5730,10 @@ if __name__ == '__main__':
         print(Colors.ENDC)
         sys.exit(0)
 
+    if opts.sample_sheet :
+        run_sample_sheet(opts, unknown_args)
+        sys.exit(0)
+
     # Start the analysis
     analysis = Analysis(opts, unknown_args)
     